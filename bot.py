@@ -1,21 +1,47 @@
+import atexit
+import base64
 import json
 import logging
 import asyncio
+import bisect
+import heapq
+import mmap
+import os
+import queue
+import re
 import sqlite3
+import struct
+import sys
+import threading
 import time
-from typing import Any, Dict, List, Optional
+import zlib
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
 import base58
 import aiohttp
+import numpy as np
 import websockets
 import signal
-import traceback
 from cryptography.fernet import Fernet
 from bip_utils import Bip39SeedGenerator, Bip44, Bip44Coins, Bip39MnemonicGenerator, Bip39WordsNum
+from solders.hash import Hash
+from solders.instruction import Instruction
 from solders.keypair import Keypair
+from solders.message import MessageV0
 from solders.pubkey import Pubkey
+from solders.signature import Signature
+from solders.transaction import VersionedTransaction
+from solders.transaction_status import TransactionConfirmationStatus
 from solana.rpc.async_api import AsyncClient
 from solana.rpc.core import RPCException
 from solana.rpc.commitment import Confirmed
+try:
+    from solana.rpc.models import TxOpts
+except ImportError:  # solana-py < 0.40
+    from solana.rpc.types import TxOpts
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
@@ -33,16 +59,269 @@ TELEGRAM_TOKEN = "7594787474:AAFj8_wxiZXGcpNfFB2C77jBLQu9U0DP2A0"  # Replace wit
 RPC_URL = "https://api.mainnet-beta.solana.com"
 COINGECKO_URL = "https://api.coingecko.com/api/v3/simple/price"
 RAYDIUM_API_URL = "https://api-v3.raydium.io/pools/info/mint"
+RAYDIUM_KEYS_URL = "https://api-v3.raydium.io/pools/key/ids"
 PUMP_WSS = "wss://pumpportal.fun/api/data"
+RPC_UPSTREAM = f"rpc:{RPC_URL}"
+RPC_WSS = "wss://api.mainnet-beta.solana.com"
+# Signed transactions are broadcast to every endpoint at once
+RPC_SEND_URLS = [RPC_URL]
+WSOL_MINT = "So11111111111111111111111111111111111111112"
+PUMP_PROGRAM_ID = "6EF8rrecthR5Dkzon8Nwu78hRvfCKubJ14M5uBEwF6P"
+PUMP_TOKEN_DECIMALS = 6
+CRYPTO_WORKERS = 4
+WALLET_POOL_SIZE = 5
+DEFAULT_SNIPE_AMOUNT = 1.0
+DEFAULT_SLIPPAGE = 0.5  # percent
+SWAP_FEE = 0.0025
+PUMP_FEE = 0.01
+POOL_CACHE_SIZE = 2000
+LEDGER_RECONCILE_INTERVAL = 15  # seconds
+LEDGER_SETTLE_GRACE = 60  # seconds before an on-chain read is trusted to include a settled trade
+LEDGER_IDLE_TTL = 600  # seconds an idle wallet stays in the ledger
+SESSION_MAX = 10000
+SESSION_IDLE_TTL = 1800  # seconds before an idle session is evicted
+SESSION_WALLET_TTL = 300  # seconds before an idle session drops its decrypted keypair
+SESSION_RECENT_TRADES = 20
+SESSION_SWEEP_INTERVAL = 60  # seconds
+BLOCKHASH_REFRESH_INTERVAL = 2  # seconds
+BLOCKHASH_MAX_AGE = 30  # seconds before a cached blockhash is fetched inline instead
+BLOCKHASH_IDLE_TIMEOUT = 60  # seconds without submissions before background refresh stops
+TX_STATUS_POLL_INTERVAL = 1.5  # seconds
+TX_REBROADCAST_INTERVAL = 2  # seconds between resends of an unconfirmed transaction
+SNIPE_POOL_HISTORY = 1000
+PUMP_RECORD_DIR: Optional[str] = None  # e.g. "recordings" to capture the raw pump.fun stream
+PUMP_RECORD_SEGMENT_BYTES = 64 * 1024 * 1024
+PRICE_HISTORY_DIR: Optional[str] = None  # e.g. "prices" to keep OHLC history across restarts
+PRICE_HISTORY_TOKENS = 512
+# Bar width in seconds -> bars kept per token (15 minutes of 1s, a day of 1m, 30 days of 1h)
+PRICE_HISTORY_BARS = {1: 900, 60: 1440, 3600: 720}
+SOL_PRICE_KEY = "SOL/USD"
+STATE_DIR = "state"
+STATE_SNAPSHOT_INTERVAL = 30  # seconds
+
+# Lower values are served first when an upstream is saturated
+PRIORITY_SNIPE = 0
+PRIORITY_TRADE = 1
+PRIORITY_BACKGROUND = 2
+# Upstream name (RPC endpoints share the "rpc" entry): requests/s, burst, max concurrency
+UPSTREAM_LIMITS = {
+    "coingecko": (0.5, 5, 2),
+    "binance": (10.0, 20, 8),
+    "raydium": (5.0, 10, 4),
+    "rpc": (10.0, 40, 16),
+}
+
+LOG_FILE = "bot.log"
+LOG_MAX_BYTES = 20 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_JSON = False
+LOG_BATCH_SIZE = 256
+# When the writer falls behind, DEBUG/INFO records are dropped (and counted) once the queue is full
+LOG_QUEUE_SIZE = 10000
+# Repeats of one warning/error message beyond LOG_SAMPLE_BURST per window are dropped and counted
+LOG_SAMPLE_WINDOW = 60  # seconds
+LOG_SAMPLE_BURST = 5
+LOG_SAMPLE_MAX_KEYS = 10000
 
 # =============================================================================
 # 2. LOGGING CONFIGURATION
 # =============================================================================
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[logging.FileHandler("bot.log"), logging.StreamHandler()]
+# Records are queued by the calling thread and formatted (tracebacks
+# included), batched, written and rotated by a background writer thread.
+# The queue is bounded; see AsyncLogWriter.put for what happens when full.
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class RepeatSampler(logging.Filter):
+    # Keyed on call site plus the rendered message, so one noisy user does not
+    # hide another user's errors from the same line. Counts for messages that
+    # stop repeating are reported by expire(), which the log writer calls.
+    def __init__(self, window: float, burst: int, max_keys: int = LOG_SAMPLE_MAX_KEYS):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._sites: Dict[Tuple[str, int, str], List[Any]] = {}  # key -> [window start, count, summary fields]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        message = record.getMessage()
+        key = (record.pathname, record.lineno, message)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or record.created - site[0] >= self.window:
+                suppressed = site[1] - self.burst if site else 0
+                if site is None and len(self._sites) >= self.max_keys:
+                    # Too many distinct messages to track; let this one through unsampled
+                    return True
+                self._sites[key] = [record.created, 1, {
+                    "name": record.name, "levelno": record.levelno, "levelname": record.levelname,
+                    "pathname": record.pathname, "lineno": record.lineno, "msg": message,
+                }]
+                if suppressed > 0:
+                    record.msg = f"{message} [{suppressed} similar messages suppressed]"
+                    record.args = None
+                return True
+            site[1] += 1
+            return site[1] <= self.burst
+
+    def expire(self, now: Optional[float] = None) -> List[logging.LogRecord]:
+        # Drops finished windows (all of them when now is None) and returns a
+        # summary record for each one that suppressed messages
+        summaries = []
+        with self._lock:
+            for key, (started, count, fields) in list(self._sites.items()):
+                if now is not None and now - started < self.window:
+                    continue
+                del self._sites[key]
+                if count > self.burst:
+                    summaries.append(logging.makeLogRecord(
+                        dict(fields, msg=f"[{count - self.burst} similar messages suppressed] {fields['msg']}")
+                    ))
+        return summaries
+
+class AsyncLogWriter(threading.Thread):
+    def __init__(
+        self, path: str, formatter: logging.Formatter, max_bytes: int, backup_count: int,
+        batch_size: int, stream: Optional[Any] = None, max_queue: int = LOG_QUEUE_SIZE,
+        sampler: Optional[RepeatSampler] = None
+    ):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue: "queue.Queue[Optional[logging.LogRecord]]" = queue.Queue(max_queue)
+        self.sampler = sampler
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.path = path
+        self.formatter = formatter
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.stream = stream
+        self._file = open(path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def put(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Warnings and errors wait briefly for room; routine records are dropped
+            if record.levelno >= logging.WARNING:
+                try:
+                    self.queue.put(record, timeout=1.0)
+                    return
+                except queue.Full:
+                    pass
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _format(self, record: logging.LogRecord) -> str:
+        try:
+            return self.formatter.format(record)
+        except Exception:
+            return f"Unformattable log record from {record.pathname}:{record.lineno}"
+
+    def run(self) -> None:
+        stopping = False
+        next_expire = time.time() + 1.0
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=1.0)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for record in batch:
+                if record is None:
+                    stopping = True
+                    continue
+                lines.append(self._format(record))
+            if self.dropped:
+                with self._dropped_lock:
+                    dropped, self.dropped = self.dropped, 0
+                lines.append(self._format(logging.makeLogRecord({
+                    "name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"Log queue full: dropped {dropped} records",
+                })))
+            now = time.time()
+            if self.sampler and (stopping or now >= next_expire):
+                lines.extend(self._format(r) for r in self.sampler.expire(None if stopping else now))
+                next_expire = now + 1.0
+            if lines:
+                self._write("\n".join(lines) + "\n")
+        self._file.close()
+
+    def _write(self, text: str) -> None:
+        try:
+            size = len(text.encode("utf-8"))
+            if self._size and self._size + size > self.max_bytes:
+                self._rotate()
+            self._file.write(text)
+            self._file.flush()
+            self._size += size
+            if self.stream:
+                self.stream.write(text)
+                self.stream.flush()
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"Log writer error: {e}\n")
+
+    def _rotate(self) -> None:
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._size = 0
+
+    def stop(self, timeout: float = 5.0) -> None:
+        if self.is_alive():
+            self.queue.put(None)
+            self.join(timeout)
+
+class QueueLogHandler(logging.Handler):
+    def __init__(self, writer: AsyncLogWriter):
+        super().__init__()
+        self.writer = writer
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # The writer queue is thread-safe, so skip the handler lock
+        rv = self.filter(record)
+        if rv:
+            self.writer.put(record)
+        return rv
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.writer.put(record)
+
+log_formatter = (
+    JsonLogFormatter() if LOG_JSON
+    else logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+)
+log_sampler = RepeatSampler(LOG_SAMPLE_WINDOW, LOG_SAMPLE_BURST)
+log_writer = AsyncLogWriter(
+    LOG_FILE, log_formatter, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_BATCH_SIZE, sys.stderr, sampler=log_sampler
 )
+log_writer.start()
+atexit.register(log_writer.stop)
+log_handler = QueueLogHandler(log_writer)
+log_handler.addFilter(log_sampler)
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
 logger = logging.getLogger(__name__)
 
 # =============================================================================
@@ -65,12 +344,34 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS trade_signatures (
+            signature TEXT PRIMARY KEY,
+            user_id INTEGER,
+            trade_data TEXT,
+            raw_tx BLOB,
+            last_valid_block_height INTEGER,
+            lamports INTEGER,
+            status TEXT,
+            slot INTEGER,
+            error TEXT,
+            submitted_at REAL,
+            finalized_at REAL
+        )
+    """)
     c.execute("""
         CREATE TABLE IF NOT EXISTS settings (
             user_id INTEGER PRIMARY KEY,
             settings_data TEXT
         )
     """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS wallet_pool (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            encrypted_wallet BLOB,
+            encryption_key BLOB
+        )
+    """)
     conn.commit()
     conn.close()
 
@@ -79,30 +380,132 @@ init_db()
 # =============================================================================
 # 4. GLOBAL STORAGE
 # =============================================================================
-user_wallets: Dict[int, Keypair] = {}
-active_snipers: Dict[int, List[str]] = {}
-user_settings: Dict[int, Dict[str, Any]] = {}
 limit_orders: Dict[int, Dict[str, Any]] = {}
 dca_orders: Dict[int, List[Dict[str, Any]]] = {}
-trades: Dict[int, List[str]] = {}
-referrals: Dict[int, str] = {}
 supported_langs: List[str] = ['EN', 'ZH', 'ES', 'RU']
-snipe_pools: List[Dict[str, Any]] = []
-pending_orders: Dict[int, Dict[str, str]] = {}
-pending_wallet: Dict[int, bool] = {}
-connection_attempts: Dict[int, int] = {}
+snipe_pools: Deque[Dict[str, Any]] = deque(maxlen=SNIPE_POOL_HISTORY)
+copy_traders: Dict[int, List[str]] = {}
+copy_tasks: Dict[Tuple[int, str], "asyncio.Task[None]"] = {}
 
-wallet_lock = asyncio.Lock()
+wallet_locks: Dict[int, List[Any]] = {}  # user_id -> [lock, holders and waiters]
+wallet_loads: Dict[int, "asyncio.Future[Optional[Keypair]]"] = {}
 orders_lock = asyncio.Lock()
 
 # =============================================================================
-# 5. INITIALIZE CLIENTS
+# 5. SESSION STORE
+# =============================================================================
+# Per-user interactive state lives in one LRU-bounded store. Idle sessions
+# drop their decrypted keypair after SESSION_WALLET_TTL and are evicted after
+# SESSION_IDLE_TTL; both are reloaded from the DB on the next access.
+class UserSession:
+    __slots__ = (
+        "user_id", "wallet", "settings", "pending_order", "pending_wallet",
+        "connection_attempts", "recent_trades", "referral", "last_seen",
+    )
+
+    def __init__(self, user_id: int, settings: Dict[str, Any]):
+        self.user_id = user_id
+        self.wallet: Optional[Keypair] = None
+        self.settings = settings
+        self.pending_order: Optional[Dict[str, str]] = None
+        self.pending_wallet = False
+        self.connection_attempts = 0
+        self.recent_trades: Deque[str] = deque(maxlen=SESSION_RECENT_TRADES)
+        self.referral: Optional[str] = None
+        self.last_seen = time.monotonic()
+
+    def memory_bytes(self) -> int:
+        size = sys.getsizeof(self) + sys.getsizeof(self.settings) + sys.getsizeof(self.recent_trades)
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.settings.items())
+        size += sum(sys.getsizeof(t) for t in self.recent_trades)
+        if self.pending_order:
+            size += sys.getsizeof(self.pending_order)
+            size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.pending_order.items())
+        if self.wallet is not None:
+            size += sys.getsizeof(self.wallet)
+        if self.referral:
+            size += sys.getsizeof(self.referral)
+        return size
+
+class SessionStore:
+    def __init__(self, max_sessions: int, idle_ttl: float, wallet_ttl: float):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.wallet_ttl = wallet_ttl
+        self._sessions: "OrderedDict[int, UserSession]" = OrderedDict()
+
+    def get(self, user_id: int) -> UserSession:
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._sessions[user_id] = UserSession(user_id, load_settings(user_id))
+            while len(self._sessions) > self.max_sessions:
+                # Sessions waiting on user input are kept; the store may run over until they clear
+                victim = next(
+                    (uid for uid, s in self._sessions.items() if s.pending_order is None and not s.pending_wallet),
+                    user_id,
+                )
+                if victim == user_id:
+                    break
+                self._evict(victim)
+        else:
+            self._sessions.move_to_end(user_id)
+            session.last_seen = time.monotonic()
+        return session
+
+    def peek(self, user_id: int) -> Optional[UserSession]:
+        return self._sessions.get(user_id)
+
+    def values(self) -> List[UserSession]:
+        return list(self._sessions.values())
+
+    def _evict(self, user_id: int) -> None:
+        session = self._sessions.pop(user_id)
+        if session.pending_order is not None:
+            state_journal.record("pending_orders", user_id, None)
+
+    def sweep(self) -> None:
+        now = time.monotonic()
+        # Oldest first; stop at the first session that is still fresh
+        for user_id, session in list(self._sessions.items()):
+            idle = now - session.last_seen
+            if idle < self.wallet_ttl:
+                break
+            session.wallet = None
+            if idle >= self.idle_ttl:
+                self._evict(user_id)
+
+    def memory_report(self) -> Dict[str, int]:
+        sizes = [session.memory_bytes() for session in self._sessions.values()]
+        return {
+            "sessions": len(sizes),
+            "wallets": sum(1 for session in self._sessions.values() if session.wallet is not None),
+            "bytes": sum(sizes),
+            "avg_bytes": sum(sizes) // len(sizes) if sizes else 0,
+        }
+
+sessions = SessionStore(SESSION_MAX, SESSION_IDLE_TTL, SESSION_WALLET_TTL)
+
+async def sweep_sessions() -> None:
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        sessions.sweep()
+        report = sessions.memory_report()
+        if report["sessions"]:
+            logger.info(
+                f"Sessions: {report['sessions']} ({report['wallets']} with decrypted keys), "
+                f"~{report['bytes'] / 1024:.1f} KiB total, {report['avg_bytes']} B/session"
+            )
+
+# =============================================================================
+# 6. INITIALIZE CLIENTS
 # =============================================================================
 solana_client = AsyncClient(RPC_URL)
+send_clients = [(f"rpc:{url}", AsyncClient(url)) for url in RPC_SEND_URLS]
+crypto_executor = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto")
 application = None
 
 # =============================================================================
-# 6. SECURITY HELPERS
+# 7. SECURITY HELPERS
 # =============================================================================
 def generate_encryption_key(user_id: int) -> bytes:
     return Fernet.generate_key()
@@ -116,6 +519,21 @@ def decrypt_wallet_key(encrypted_key: bytes, encryption_key: bytes) -> Keypair:
     key_bytes = fernet.decrypt(encrypted_key)
     return Keypair.from_bytes(key_bytes)
 
+def derive_keypair(mnemonic: str) -> Keypair:
+    seed_bytes = Bip39SeedGenerator(mnemonic).Generate()
+    bip44_ctx = Bip44.FromSeed(seed_bytes, Bip44Coins.SOLANA).DeriveDefaultPath()
+    return Keypair.from_seed(bip44_ctx.PrivateKey().Raw().ToBytes())
+
+def new_wallet() -> Tuple[str, Keypair]:
+    mnemonic = Bip39MnemonicGenerator().FromWordsNumber(Bip39WordsNum.WORDS_NUM_12).ToStr()
+    return mnemonic, derive_keypair(mnemonic)
+
+async def run_crypto(func: Callable[..., Any], *args: Any) -> Any:
+    # Seed derivation (PBKDF2), Fernet and the sqlite calls around them block,
+    # so they run on the crypto pool instead of the event loop.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(crypto_executor, func, *args)
+
 def store_wallet(user_id: int, keypair: Keypair):
     encryption_key = generate_encryption_key(user_id)
     encrypted_key = encrypt_wallet_key(keypair, encryption_key)
@@ -161,21 +579,118 @@ def load_settings(user_id: int) -> Dict[str, Any]:
     conn.close()
     return json.loads(result[0]) if result else {}
 
+@asynccontextmanager
+async def user_wallet_lock(user_id: int) -> AsyncIterator[None]:
+    entry = wallet_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del wallet_locks[user_id]
+
+async def get_user_wallet(user_id: int) -> Optional[Keypair]:
+    session = sessions.get(user_id)
+    if session.wallet is not None:
+        return session.wallet
+    # One load per user in flight; different users decrypt in parallel on the crypto pool
+    future = wallet_loads.get(user_id)
+    if future is None:
+        future = wallet_loads[user_id] = asyncio.ensure_future(run_crypto(load_wallet, user_id))
+        future.add_done_callback(lambda _: wallet_loads.pop(user_id, None))
+    wallet = await asyncio.shield(future)
+    if wallet and session.wallet is None:
+        session.wallet = wallet
+    return session.wallet
+
 # =============================================================================
-# 7. WALLET GENERATION
+# 8. WALLET GENERATION
 # =============================================================================
+def create_pooled_wallet() -> None:
+    mnemonic, keypair = new_wallet()
+    encryption_key = Fernet.generate_key()
+    payload = json.dumps({"mnemonic": mnemonic, "key": base58.b58encode(keypair.to_bytes()).decode()})
+    encrypted_wallet = Fernet(encryption_key).encrypt(payload.encode())
+    conn = sqlite3.connect("bot.db")
+    c = conn.cursor()
+    c.execute(
+        "INSERT INTO wallet_pool (encrypted_wallet, encryption_key) VALUES (?, ?)",
+        (encrypted_wallet, encryption_key)
+    )
+    conn.commit()
+    conn.close()
+
+def take_pooled_wallet() -> Optional[Tuple[str, Keypair]]:
+    conn = sqlite3.connect("bot.db")
+    c = conn.cursor()
+    try:
+        while True:
+            c.execute("SELECT id, encrypted_wallet, encryption_key FROM wallet_pool ORDER BY id LIMIT 1")
+            row = c.fetchone()
+            if not row:
+                return None
+            c.execute("DELETE FROM wallet_pool WHERE id = ?", (row[0],))
+            conn.commit()
+            # Another worker may have claimed the same row first
+            if c.rowcount == 1:
+                break
+    finally:
+        conn.close()
+    _, encrypted_wallet, encryption_key = row
+    payload = json.loads(Fernet(encryption_key).decrypt(encrypted_wallet))
+    return payload["mnemonic"], Keypair.from_bytes(base58.b58decode(payload["key"]))
+
+def count_pooled_wallets() -> int:
+    conn = sqlite3.connect("bot.db")
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM wallet_pool")
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
+class WalletPool:
+    def __init__(self, size: int):
+        self.size = size
+        self._refill_task: Optional[asyncio.Task] = None
+
+    async def take(self) -> Optional[Tuple[str, Keypair]]:
+        try:
+            wallet = await run_crypto(take_pooled_wallet)
+        except Exception as e:
+            logger.error(f"Error taking wallet from pool: {e}")
+            wallet = None
+        self.schedule_refill()
+        return wallet
+
+    def schedule_refill(self) -> None:
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self.refill())
+
+    async def refill(self) -> None:
+        # One wallet at a time so refills never occupy more than one crypto worker
+        try:
+            missing = self.size - await run_crypto(count_pooled_wallets)
+            for _ in range(missing):
+                await run_crypto(create_pooled_wallet)
+            if missing > 0:
+                logger.info(f"Wallet pool refilled with {missing} wallets")
+        except Exception as e:
+            logger.error(f"Wallet pool refill failed: {e}")
+
+wallet_pool = WalletPool(WALLET_POOL_SIZE)
+
 async def generate_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     try:
-        mnemonic = Bip39MnemonicGenerator().FromWordsNumber(Bip39WordsNum.WORDS_NUM_12).ToStr()
-        seed_bytes = Bip39SeedGenerator(mnemonic).Generate()
-        bip44_ctx = Bip44.FromSeed(seed_bytes, Bip44Coins.SOLANA).DeriveDefaultPath()
-        keypair = Keypair.from_bytes(bip44_ctx.PrivateKey().Raw().ToBytes())
+        pooled = await wallet_pool.take()
+        mnemonic, keypair = pooled if pooled else await run_crypto(new_wallet)
         private_key = base58.b58encode(keypair.secret_key).decode()
 
-        async with wallet_lock:
-            user_wallets[user_id] = keypair
-            store_wallet(user_id, keypair)
+        async with user_wallet_lock(user_id):
+            sessions.get(user_id).wallet = keypair
+            await run_crypto(store_wallet, user_id, keypair)
 
         message = (
             f"🎉 New Solana wallet generated!\n\n"
@@ -187,75 +702,973 @@ async def generate_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await context.bot.send_message(chat_id=user_id, text=message, parse_mode="Markdown")
         logger.info(f"Wallet generated for user {user_id}: {keypair.public_key}")
     except Exception as e:
-        logger.error(f"Error generating wallet for user {user_id}: {e}\n{traceback.format_exc()}")
+        logger.error(f"Error generating wallet for user {user_id}: {e}", exc_info=True)
         await context.bot.send_message(chat_id=user_id, text="❌ Error generating wallet.")
 
 # =============================================================================
-# 8. HELPER FUNCTIONS
+# 9. RATE LIMITING
+# =============================================================================
+def rate_limit_info(exc: Optional[BaseException]) -> Tuple[bool, Optional[float]]:
+    # solana-py re-raises HTTP errors as SolanaRpcException(...) from the
+    # httpx error, so the status may only be found further down the chain
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        status = getattr(exc, "status", None)
+        headers = getattr(exc, "headers", None)
+        response = getattr(exc, "response", None)
+        if status is None and response is not None:
+            status = getattr(response, "status_code", None)
+            headers = getattr(response, "headers", None)
+        if status == 429:
+            break
+        exc = exc.__cause__ or exc.__context__
+    else:
+        return False, None
+    try:
+        retry_after = float(headers.get("Retry-After")) if headers and headers.get("Retry-After") else None
+    except ValueError:
+        retry_after = None
+    return True, retry_after
+
+class UpstreamLimiter:
+    # Token bucket for request rate plus AIMD concurrency: each 429 halves the
+    # concurrency limit and pauses the upstream, successes grow it back by
+    # roughly one slot per window of successful calls.
+    def __init__(self, name: str, rate: float, burst: int, max_concurrency: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._throttle_streak = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _dispatch(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        while self._waiters:
+            if self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.in_flight >= int(self.concurrency):
+                return
+            wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            _, _, future = heapq.heappop(self._waiters)
+            self.tokens -= 1
+            self.in_flight += 1
+            future.set_result(None)
+
+    async def acquire(self, priority: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Granted a slot but cancelled before using it
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None) -> None:
+        self.in_flight -= 1
+        if throttled:
+            self._throttle_streak += 1
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self.tokens = 0.0
+            pause = retry_after if retry_after is not None else min(2 ** self._throttle_streak, 60)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            logger.warning(
+                f"{self.name} rate limited: pausing {pause:.1f}s, concurrency now {int(self.concurrency)}"
+            )
+        else:
+            self._throttle_streak = 0
+            self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+        self._dispatch()
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Tuple[float, int, int]]):
+        self.limits = limits
+        self._upstreams: Dict[str, UpstreamLimiter] = {}
+
+    def upstream(self, name: str) -> UpstreamLimiter:
+        limiter = self._upstreams.get(name)
+        if limiter is None:
+            rate, burst, max_concurrency = self.limits[name.split(":", 1)[0]]
+            limiter = self._upstreams[name] = UpstreamLimiter(name, rate, burst, max_concurrency)
+        return limiter
+
+    @asynccontextmanager
+    async def limit(
+        self, name: str, priority: int = PRIORITY_TRADE, timeout: Optional[float] = None
+    ) -> AsyncIterator[None]:
+        upstream = self.upstream(name)
+        await asyncio.wait_for(upstream.acquire(priority), timeout)
+        throttled, retry_after = False, None
+        try:
+            yield
+        except Exception as e:
+            throttled, retry_after = rate_limit_info(e)
+            raise
+        finally:
+            upstream.release(throttled, retry_after)
+
+rate_limiter = RateLimiter(UPSTREAM_LIMITS)
+
+# =============================================================================
+# 10. POOL STATE & QUOTES
+# =============================================================================
+# Reserves are kept current through accountSubscribe on the pump.fun bonding
+# curve account, or on the two Raydium vault token accounts, so quotes are
+# computed locally instead of costing a round trip per trade. Raydium
+# reserves are read straight from the vaults (pending AMM PnL is ignored).
+# Trade sizes are lamports on both sides, as in execute_trade: a sell of N
+# lamports sells the tokens worth N at the current spot price.
+@dataclass(slots=True)
+class PoolState:
+    kind: str  # "pump" or "raydium"
+    address: str  # bonding curve or Raydium pool id
+    token_reserve: int = 0  # raw token units (virtual for pump)
+    sol_reserve: int = 0  # lamports (virtual for pump)
+    fee: float = SWAP_FEE
+    real_token_reserve: Optional[int] = None
+    complete: bool = False
+    slot: int = 0
+    decimals: int = PUMP_TOKEN_DECIMALS
+
+    def price(self) -> Optional[float]:
+        # SOL per whole token
+        if self.token_reserve <= 0 or self.sol_reserve <= 0:
+            return None
+        return (self.sol_reserve / 1e9) / (self.token_reserve / 10 ** self.decimals)
+
+@dataclass(frozen=True)
+class Quote:
+    amount_in: int
+    expected_out: int
+    min_out: int
+    price_impact: float  # percent
+
+class PoolStateCache:
+    def __init__(self, ws_url: str, max_pools: int = POOL_CACHE_SIZE):
+        self.ws_url = ws_url
+        self.max_pools = max_pools
+        self.pools: Dict[str, PoolState] = {}
+        self._accounts: Dict[str, Tuple[str, str]] = {}  # account -> (mint, role)
+        self._sub_by_account: Dict[str, int] = {}
+        self._account_by_sub: Dict[int, str] = {}
+        self._account_by_request: Dict[int, str] = {}
+        self._outbox: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+        self._request_id = 0
+
+    def get(self, mint: str) -> Optional[PoolState]:
+        return self.pools.get(mint)
+
+    def _add_pool(self, mint: str, pool: PoolState, accounts: Dict[str, str]) -> None:
+        self.pools[mint] = pool
+        for account, role in accounts.items():
+            self._accounts[account] = (mint, role)
+            self._outbox.put_nowait(("subscribe", account))
+        while len(self.pools) > self.max_pools:
+            self._evict(next(iter(self.pools)))
+
+    def _evict(self, mint: str) -> None:
+        del self.pools[mint]
+        for account in [a for a, (m, _) in self._accounts.items() if m == mint]:
+            del self._accounts[account]
+            sub_id = self._sub_by_account.pop(account, None)
+            if sub_id is not None:
+                self._account_by_sub.pop(sub_id, None)
+                self._outbox.put_nowait(("unsubscribe", sub_id))
+
+    def track_pump(
+        self, mint: str, curve: Optional[str] = None,
+        virtual_tokens: Optional[float] = None, virtual_sol: Optional[float] = None
+    ) -> None:
+        if mint in self.pools:
+            return
+        if not curve:
+            curve = str(Pubkey.find_program_address(
+                [b"bonding-curve", bytes(Pubkey.from_string(mint))], Pubkey.from_string(PUMP_PROGRAM_ID)
+            )[0])
+        pool = PoolState(kind="pump", address=curve, fee=PUMP_FEE)
+        if virtual_tokens and virtual_sol:
+            pool.token_reserve = int(virtual_tokens * 10 ** PUMP_TOKEN_DECIMALS)
+            pool.sol_reserve = int(virtual_sol * 1e9)
+            price_history.record(mint, pool.price())
+        self._add_pool(mint, pool, {curve: "curve"})
+        if not pool.sol_reserve:
+            asyncio.create_task(self._seed([curve], PRIORITY_BACKGROUND))
+
+    def _tracking(self, mint: str) -> bool:
+        # A completed bonding curve has migrated to Raydium and gives way to the Raydium pool
+        pool = self.pools.get(mint)
+        return pool is not None and not (pool.kind == "pump" and pool.complete)
+
+    async def track_raydium(self, mint: str, pool_id: str, priority: int = PRIORITY_TRADE) -> None:
+        if self._tracking(mint):
+            return
+        async with aiohttp.ClientSession() as session:
+            try:
+                async with rate_limiter.limit("raydium", priority):
+                    async with session.get(
+                        RAYDIUM_KEYS_URL, params={"ids": pool_id}, timeout=aiohttp.ClientTimeout(total=10)
+                    ) as resp:
+                        if resp.status == 429:
+                            raise aiohttp.ClientResponseError(
+                                resp.request_info, resp.history, status=429,
+                                message="Rate limit exceeded", headers=resp.headers
+                            )
+                        data = await resp.json()
+                keys = data["data"][0]
+                vault_a, vault_b = keys["vault"]["A"], keys["vault"]["B"]
+                if keys["mintA"]["address"] == WSOL_MINT:
+                    sol_vault, token_vault = vault_a, vault_b
+                    decimals = int(keys["mintB"]["decimals"])
+                else:
+                    sol_vault, token_vault = vault_b, vault_a
+                    decimals = int(keys["mintA"]["decimals"])
+            except (aiohttp.ClientError, KeyError, IndexError, TypeError, ValueError) as e:
+                logger.error(f"Error fetching Raydium pool keys for {mint}: {e!r}")
+                return
+        if self._tracking(mint):
+            return
+        if mint in self.pools:
+            self._evict(mint)
+        self._add_pool(
+            mint, PoolState(kind="raydium", address=pool_id, decimals=decimals),
+            {token_vault: "token_vault", sol_vault: "sol_vault"}
+        )
+        await self._seed([token_vault, sol_vault], priority)
+
+    async def _seed(self, accounts: List[str], priority: int) -> None:
+        try:
+            async with rate_limiter.limit(RPC_UPSTREAM, priority):
+                resp = await solana_client.get_multiple_accounts([Pubkey.from_string(a) for a in accounts])
+            for account, info in zip(accounts, resp.value):
+                if info is not None:
+                    self._apply(account, bytes(info.data), resp.context.slot)
+        except Exception as e:
+            logger.error(f"Error seeding pool accounts {accounts}: {e!r}")
+
+    def _apply(self, account: str, data: bytes, slot: int) -> None:
+        entry = self._accounts.get(account)
+        if entry is None:
+            return
+        mint, role = entry
+        pool = self.pools.get(mint)
+        if pool is None or slot < pool.slot:
+            return
+        try:
+            if role == "curve":
+                virtual_tokens, virtual_sol, real_tokens = struct.unpack_from("<QQQ", data, 8)
+                pool.token_reserve, pool.sol_reserve = virtual_tokens, virtual_sol
+                pool.real_token_reserve = real_tokens
+                pool.complete = len(data) > 48 and data[48] != 0
+            elif role == "token_vault":
+                pool.token_reserve = struct.unpack_from("<Q", data, 64)[0]
+            elif role == "sol_vault":
+                pool.sol_reserve = struct.unpack_from("<Q", data, 64)[0]
+        except struct.error:
+            logger.warning(f"Unexpected account layout for {account} ({role})")
+            return
+        pool.slot = slot
+        price_history.record(mint, pool.price())
+
+    def quote_batch(
+        self, mint: str, side: str, lamports: List[int], slippages: List[float]
+    ) -> Optional[List[Quote]]:
+        pool = self.pools.get(mint)
+        if pool is None or pool.complete or pool.token_reserve <= 0 or pool.sol_reserve <= 0:
+            return None
+        sizes = np.asarray(lamports, dtype=np.float64)
+        tolerance = 1 - np.asarray(slippages, dtype=np.float64) / 100
+        if side == "buy":
+            amount_in = sizes
+            reserve_in, reserve_out = pool.sol_reserve, pool.token_reserve
+            net_in = amount_in * (1 - pool.fee)
+            out = reserve_out * net_in / (reserve_in + net_in)
+            if pool.real_token_reserve is not None:
+                out = np.minimum(out, pool.real_token_reserve)
+        else:
+            amount_in = np.floor(sizes * pool.token_reserve / pool.sol_reserve)
+            reserve_in, reserve_out = pool.token_reserve, pool.sol_reserve
+            # Raydium takes its fee from the input, pump.fun from the SOL paid out
+            net_in = amount_in * (1 - pool.fee) if pool.kind == "raydium" else amount_in
+            out = reserve_out * net_in / (reserve_in + net_in)
+            if pool.kind == "pump":
+                out = out * (1 - pool.fee)
+        impact = net_in / (reserve_in + net_in) * 100
+        expected = np.floor(out)
+        min_out = np.floor(out * tolerance)
+        return [
+            Quote(int(a), int(e), int(m), float(i))
+            for a, e, m, i in zip(amount_in.tolist(), expected.tolist(), min_out.tolist(), impact.tolist())
+        ]
+
+    def quote(self, mint: str, side: str, lamports: int, slippage: float) -> Optional[Quote]:
+        quotes = self.quote_batch(mint, side, [lamports], [slippage])
+        return quotes[0] if quotes else None
+
+    async def _send_outbox(self, ws: Any) -> None:
+        while True:
+            op, arg = await self._outbox.get()
+            self._request_id += 1
+            if op == "subscribe":
+                if arg not in self._accounts or arg in self._sub_by_account:
+                    continue
+                self._account_by_request[self._request_id] = arg
+                params = [arg, {"encoding": "base64", "commitment": "processed"}]
+                await ws.send(json.dumps({"jsonrpc": "2.0", "id": self._request_id, "method": "accountSubscribe", "params": params}))
+            else:
+                await ws.send(json.dumps({"jsonrpc": "2.0", "id": self._request_id, "method": "accountUnsubscribe", "params": [arg]}))
+
+    def _handle(self, message: Union[str, bytes]) -> None:
+        data = json.loads(message)
+        if "id" in data:
+            account = self._account_by_request.pop(data["id"], None)
+            if account is not None and isinstance(data.get("result"), int):
+                if account in self._accounts:
+                    self._sub_by_account[account] = data["result"]
+                    self._account_by_sub[data["result"]] = account
+                else:
+                    self._outbox.put_nowait(("unsubscribe", data["result"]))
+            return
+        if data.get("method") != "accountNotification":
+            return
+        params = data["params"]
+        account = self._account_by_sub.get(params["subscription"])
+        value = params["result"]["value"]
+        if account is None or value is None:
+            return
+        self._apply(account, base64.b64decode(value["data"][0]), params["result"]["context"]["slot"])
+
+    async def run(self) -> None:
+        reconnect_delay = 5
+        while True:
+            sender = None
+            try:
+                async with websockets.connect(self.ws_url, ping_interval=20, ping_timeout=10) as ws:
+                    logger.info("Connected to RPC WebSocket for pool updates")
+                    reconnect_delay = 5
+                    # Subscriptions do not survive a reconnect; queue every tracked account again
+                    self._sub_by_account.clear()
+                    self._account_by_sub.clear()
+                    self._account_by_request.clear()
+                    while not self._outbox.empty():
+                        self._outbox.get_nowait()
+                    for account in self._accounts:
+                        self._outbox.put_nowait(("subscribe", account))
+                    sender = asyncio.create_task(self._send_outbox(ws))
+                    async for message in ws:
+                        try:
+                            self._handle(message)
+                        except (KeyError, TypeError, ValueError) as e:
+                            logger.error(f"Error handling pool update: {e!r}")
+            except (websockets.exceptions.WebSocketException, OSError) as e:
+                logger.error(f"Pool WebSocket error: {e}")
+            finally:
+                if sender:
+                    sender.cancel()
+            await asyncio.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 1.5, 60)
+
+pool_cache = PoolStateCache(RPC_WSS)
+
+# =============================================================================
+# 11. PRICE HISTORY
 # =============================================================================
-async def get_sol_price() -> Optional[float]:
-    cache_key = "sol_price"
+# Every tracked token owns one fixed slot per bar width, and each slot is a
+# ring addressed by bucket number (start // width % bars), so a tick, the
+# latest bar and any bar lookup are O(1) and a range read is one gather.
+# Ticks are recorded as they arrive and roll into every width at once. Keys
+# are pool mints (SOL per token) plus SOL_PRICE_KEY (USD per SOL); the least
+# recently updated key gives up its slot when the store is full.
+OHLC_DTYPE = np.dtype([
+    ("start", "<i8"), ("open", "<f8"), ("high", "<f8"), ("low", "<f8"), ("close", "<f8"), ("ticks", "<u4"),
+])
+PRICE_KEY_DTYPE = np.dtype("S64")
+
+class PriceHistory:
+    def __init__(
+        self, directory: Optional[str] = None, max_tokens: int = PRICE_HISTORY_TOKENS,
+        bars: Dict[int, int] = PRICE_HISTORY_BARS, pinned: Tuple[str, ...] = (SOL_PRICE_KEY,)
+    ):
+        self.directory = directory
+        self.max_tokens = max_tokens
+        self.widths = sorted(bars)
+        self.pinned = set(pinned)
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._latest: Dict[int, np.ndarray] = {w: np.zeros(max_tokens, dtype=np.int64) for w in self.widths}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._keys = self._open(os.path.join(directory, "price_keys.bin"), PRICE_KEY_DTYPE, (max_tokens,))
+            self._rings = {
+                w: self._open(os.path.join(directory, f"ohlc_{w}s.bin"), OHLC_DTYPE, (max_tokens, bars[w]))
+                for w in self.widths
+            }
+            self._load()
+        else:
+            self._keys = np.zeros(max_tokens, dtype=PRICE_KEY_DTYPE)
+            self._rings = {w: np.zeros((max_tokens, bars[w]), dtype=OHLC_DTYPE) for w in self.widths}
+        self._free = [i for i in range(max_tokens - 1, -1, -1) if not self._keys[i]]
+
+    def _open(self, path: str, dtype: np.dtype, shape: Tuple[int, ...]) -> np.memmap:
+        size = dtype.itemsize * int(np.prod(shape))
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+        if os.path.exists(path):
+            logger.warning(f"Price history file {path} does not match the configured layout; starting it fresh")
+        return np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+
+    def _load(self) -> None:
+        for w in self.widths:
+            self._latest[w] = self._rings[w]["start"].max(axis=1)
+        # Slots whose rings were reset on a layout change carry no history
+        empty = self._latest[self.widths[0]] == 0
+        self._keys[empty] = b""
+        used = np.flatnonzero(self._keys != b"")
+        for i in used[np.argsort(self._latest[self.widths[0]][used], kind="stable")]:
+            self._slots[self._keys[i].decode()] = int(i)
+        if self._slots:
+            logger.info(f"Loaded price history for {len(self._slots)} tokens from {self.directory}")
+
+    def _slot(self, token: str) -> Optional[int]:
+        # Only writes refresh a key's place in the eviction order
+        slot = self._slots.get(token)
+        if slot is not None:
+            self._slots.move_to_end(token)
+            return slot
+        if self._free:
+            slot = self._free.pop()
+        else:
+            victim = next((t for t in self._slots if t not in self.pinned), None)
+            if victim is None:
+                return None
+            slot = self._slots.pop(victim)
+        for w in self.widths:
+            self._rings[w][slot] = 0
+            self._latest[w][slot] = 0
+        self._keys[slot] = token.encode()
+        self._slots[token] = slot
+        return slot
+
+    def record(self, token: str, price: Optional[float], ts: Optional[float] = None) -> None:
+        if price is None or not 0 < price < float("inf"):
+            return
+        slot = self._slot(token)
+        if slot is None:
+            return
+        ts = time.time() if ts is None else ts
+        for w in self.widths:
+            ring = self._rings[w]
+            start = int(ts // w) * w
+            bar = ring[slot, (start // w) % ring.shape[1]]
+            if bar["start"] == start:
+                if price > bar["high"]:
+                    bar["high"] = price
+                elif price < bar["low"]:
+                    bar["low"] = price
+                bar["close"] = price
+                bar["ticks"] += 1
+            elif bar["start"] < start:
+                ring[slot, (start // w) % ring.shape[1]] = (start, price, price, price, price, 1)
+                if start > self._latest[w][slot]:
+                    self._latest[w][slot] = start
+            # else: a late tick for a bucket the ring has already reused
+
+    def latest(self, token: str, width: Optional[int] = None) -> Optional[Tuple[float, float]]:
+        # (bar start, close) of the newest bar
+        slot = self._slots.get(token)
+        if slot is None:
+            return None
+        w = width or self.widths[0]
+        start = int(self._latest[w][slot])
+        if not start:
+            return None
+        ring = self._rings[w]
+        return float(start), float(ring[slot, (start // w) % ring.shape[1]]["close"])
+
+    def bars(self, token: str, width: int, start: Optional[float] = None, end: Optional[float] = None) -> np.ndarray:
+        # Bars with start in [start, end], oldest first; empty buckets are skipped
+        slot = self._slots.get(token)
+        last = int(self._latest[width][slot]) if slot is not None else 0
+        if not last:
+            return np.empty(0, dtype=OHLC_DTYPE)
+        ring = self._rings[width]
+        size = ring.shape[1]
+        first_bucket = last // width - size + 1
+        last_bucket = last // width
+        if start is not None:
+            first_bucket = max(first_bucket, -int(-start // width))
+        if end is not None:
+            last_bucket = min(last_bucket, int(end // width))
+        if first_bucket > last_bucket:
+            return np.empty(0, dtype=OHLC_DTYPE)
+        buckets = np.arange(first_bucket, last_bucket + 1, dtype=np.int64)
+        rows = ring[slot, buckets % size]
+        return rows[rows["start"] == buckets * width]
+
+    def series(
+        self, token: str, width: int = 60, start: Optional[float] = None, end: Optional[float] = None
+    ) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+        # Closing prices in the shape load_price_series returns, for backtest_dca/backtest_limit_orders
+        rows = self.bars(token, width, start, end)
+        return rows["start"].astype(np.float64), rows["close"].copy(), None
+
+    def tokens(self) -> List[str]:
+        return list(self._slots)
+
+    def flush(self) -> None:
+        if self.directory:
+            self._keys.flush()
+            for ring in self._rings.values():
+                ring.flush()
+
+price_history = PriceHistory(PRICE_HISTORY_DIR)
+
+# =============================================================================
+# 12. BALANCE LEDGER
+# =============================================================================
+# Trades reserve SOL against a locally tracked balance instead of calling
+# getBalance each time. Successful trades move their reservation to `spent`
+# until a later on-chain read is old enough to include them
+# (LEDGER_SETTLE_GRACE). Wallets with activity are re-read in the background
+# with batched getMultipleAccounts.
+@dataclass(slots=True)
+class WalletBalance:
+    pubkey: Any
+    confirmed: int = 0  # lamports at the last on-chain read
+    reserved: int = 0  # held by trades still executing
+    spent: int = 0  # settled trades the last read may not include yet
+    spends: Deque[Tuple[float, int]] = field(default_factory=deque)
+    checked_at: float = 0.0
+
+    @property
+    def available(self) -> int:
+        return self.confirmed - self.reserved - self.spent
+
+class BalanceLedger:
+    def __init__(self):
+        self.wallets: Dict[int, WalletBalance] = {}
+        self._reservations: Dict[int, Tuple[int, WalletBalance, int]] = {}
+        self._next_id = 0
+        self._touched: set = set()
+
+    def available(self, user_id: int) -> Optional[int]:
+        balance = self.wallets.get(user_id)
+        return balance.available if balance else None
+
+    def observe(self, user_id: int, pubkey: Any, lamports: int, observed_at: Optional[float] = None) -> None:
+        observed_at = time.time() if observed_at is None else observed_at
+        balance = self.wallets.get(user_id)
+        if balance is not None and balance.pubkey is None:
+            # First read for a wallet that only has restored holds
+            balance.pubkey = pubkey
+        elif balance is None or balance.pubkey != pubkey:
+            balance = self.wallets[user_id] = WalletBalance(pubkey=pubkey)
+        balance.confirmed = lamports
+        balance.checked_at = observed_at
+        cutoff = observed_at - LEDGER_SETTLE_GRACE
+        while balance.spends and balance.spends[0][0] <= cutoff:
+            balance.spent -= balance.spends.popleft()[1]
+
+    async def refresh(self, user_id: int, pubkey: Any, priority: int = PRIORITY_TRADE) -> None:
+        observed_at = time.time()
+        async with rate_limiter.limit(RPC_UPSTREAM, priority):
+            response = await solana_client.get_balance(pubkey, commitment=Confirmed)
+        self.observe(user_id, pubkey, response.value or 0, observed_at)
+
+    async def ensure(self, user_id: int, pubkey: Any, priority: int = PRIORITY_TRADE) -> bool:
+        # True when the balance was just read on-chain
+        balance = self.wallets.get(user_id)
+        if balance is not None and balance.pubkey == pubkey:
+            return False
+        await self.refresh(user_id, pubkey, priority)
+        return True
+
+    def reserve(self, user_id: int, lamports: int) -> Optional[int]:
+        balance = self.wallets.get(user_id)
+        if balance is None or balance.available < lamports:
+            return None
+        balance.reserved += lamports
+        self._next_id += 1
+        self._reservations[self._next_id] = (user_id, balance, lamports)
+        self._touched.add(user_id)
+        return self._next_id
+
+    def hold(self, user_id: int, lamports: int) -> int:
+        # Reserves without a balance check, for trades already sent before a
+        # restart; the wallet is read on-chain on its next ensure()
+        balance = self.wallets.get(user_id)
+        if balance is None:
+            balance = self.wallets[user_id] = WalletBalance(pubkey=None)
+        balance.reserved += lamports
+        self._next_id += 1
+        self._reservations[self._next_id] = (user_id, balance, lamports)
+        return self._next_id
+
+    def held(self, reservation: int) -> int:
+        entry = self._reservations.get(reservation)
+        return entry[2] if entry else 0
+
+    def release(self, reservation: int) -> None:
+        entry = self._reservations.pop(reservation, None)
+        if entry:
+            user_id, balance, lamports = entry
+            balance.reserved -= lamports
+
+    def settle(self, reservation: int) -> None:
+        entry = self._reservations.pop(reservation, None)
+        if entry:
+            user_id, balance, lamports = entry
+            balance.reserved -= lamports
+            balance.spent += lamports
+            balance.spends.append((time.time(), lamports))
+            self._touched.add(user_id)
+
+    async def reconcile(self) -> None:
+        now = time.time()
+        for user_id in [
+            u for u, b in self.wallets.items()
+            if not b.reserved and not b.spends and u not in self._touched and now - b.checked_at > LEDGER_IDLE_TTL
+        ]:
+            del self.wallets[user_id]
+        users = [u for u, b in self.wallets.items() if b.pubkey is not None and (b.spends or u in self._touched)]
+        self._touched.clear()
+        for i in range(0, len(users), 100):
+            batch = users[i:i + 100]
+            pubkeys = [self.wallets[u].pubkey for u in batch]
+            observed_at = time.time()
+            async with rate_limiter.limit(RPC_UPSTREAM, PRIORITY_BACKGROUND):
+                response = await solana_client.get_multiple_accounts(pubkeys, commitment=Confirmed)
+            for user_id, pubkey, account in zip(batch, pubkeys, response.value):
+                balance = self.wallets.get(user_id)
+                if balance is not None and balance.pubkey == pubkey:
+                    self.observe(user_id, pubkey, account.lamports if account else 0, observed_at)
+
+balance_ledger = BalanceLedger()
+
+async def reconcile_balances() -> None:
+    while True:
+        await asyncio.sleep(LEDGER_RECONCILE_INTERVAL)
+        try:
+            await balance_ledger.reconcile()
+        except Exception as e:
+            logger.error(f"Balance reconciliation failed: {e!r}")
+
+# =============================================================================
+# 13. TRANSACTION SUBMISSION
+# =============================================================================
+# Trades are signed on the crypto pool against a cached blockhash and
+# broadcast to every RPC_SEND_URLS endpoint at once; the caller gets the
+# signature as soon as one endpoint accepts it. Confirmation is
+# tracked in the background with batched getSignatureStatuses, resending
+# until the blockhash's last valid block height has passed. The final status
+# settles or releases the ledger reservation, lands in trade_signatures (and
+# trades on success) and is reported to the user. Transactions still pending
+# at shutdown are picked up again on start.
+def sign_transaction(keypair: Keypair, instructions: List[Instruction], blockhash: Hash) -> VersionedTransaction:
+    message = MessageV0.try_compile(keypair.pubkey(), instructions, [], blockhash)
+    return VersionedTransaction(message, [keypair])
+
+class BlockhashCache:
+    # Fetched inline when stale; refreshed in the background only while
+    # transactions are being submitted, stopping after BLOCKHASH_IDLE_TIMEOUT
+    def __init__(self):
+        self.blockhash: Optional[Hash] = None
+        self.last_valid_block_height = 0
+        self.fetched_at = 0.0
+        self.used_at = 0.0
+        self._refresher: Optional["asyncio.Task[None]"] = None
+
+    async def _fetch(self, priority: int) -> None:
+        fetched_at = time.monotonic()
+        async with rate_limiter.limit(RPC_UPSTREAM, priority):
+            response = await solana_client.get_latest_blockhash(commitment=Confirmed)
+        self.blockhash = response.value.blockhash
+        self.last_valid_block_height = response.value.last_valid_block_height
+        self.fetched_at = fetched_at
+
+    async def get(self, priority: int = PRIORITY_TRADE) -> Tuple[Hash, int]:
+        self.used_at = time.monotonic()
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.create_task(self._refresh())
+        if self.blockhash is None or time.monotonic() - self.fetched_at > BLOCKHASH_MAX_AGE:
+            await self._fetch(priority)
+        return self.blockhash, self.last_valid_block_height
+
+    async def _refresh(self) -> None:
+        while True:
+            await asyncio.sleep(BLOCKHASH_REFRESH_INTERVAL)
+            if time.monotonic() - self.used_at > BLOCKHASH_IDLE_TIMEOUT:
+                return
+            try:
+                await self._fetch(PRIORITY_BACKGROUND)
+            except Exception as e:
+                logger.error(f"Blockhash refresh failed: {e!r}")
+
+@dataclass(slots=True)
+class PendingTransaction:
+    user_id: int
+    trade_data: str
+    raw: bytes
+    last_valid_block_height: int
+    reservation: Optional[int]
+    last_sent: float
+
+class TransactionPipeline:
+    def __init__(self, blockhashes: BlockhashCache):
+        self.blockhashes = blockhashes
+        self.pending: Dict[str, PendingTransaction] = {}
+        self._wake = asyncio.Event()
+        self._send_opts = TxOpts(skip_preflight=True, max_retries=0)
+
+    async def _send_one(self, upstream: str, client: AsyncClient, raw: bytes, priority: int) -> bool:
+        try:
+            async with rate_limiter.limit(upstream, priority):
+                await client.send_raw_transaction(raw, opts=self._send_opts)
+            return True
+        except Exception as e:
+            logger.warning(f"Send via {upstream} failed: {e!r}")
+            return False
+
+    async def _broadcast(self, raw: bytes, priority: int) -> bool:
+        results = await asyncio.gather(*(self._send_one(upstream, client, raw, priority) for upstream, client in send_clients))
+        return any(results)
+
+    async def submit(
+        self, user_id: int, keypair: Keypair, instructions: List[Instruction], trade_data: str,
+        reservation: Optional[int] = None, priority: int = PRIORITY_TRADE
+    ) -> Optional[str]:
+        blockhash, last_valid_block_height = await self.blockhashes.get(priority)
+        tx = await run_crypto(sign_transaction, keypair, instructions, blockhash)
+        signature, raw = str(tx.signatures[0]), bytes(tx)
+        if signature in self.pending:
+            # Same instructions against the same blockhash: the network would drop it as a duplicate
+            logger.warning(f"Transaction {signature} for user {user_id} is already in flight")
+            return None
+        # Journaled before the broadcast so a crash in between cannot lose a
+        # transaction that may still land
+        lamports = balance_ledger.held(reservation) if reservation is not None else 0
+        conn = sqlite3.connect("bot.db")
+        c = conn.cursor()
+        c.execute(
+            "INSERT OR REPLACE INTO trade_signatures "
+            "(signature, user_id, trade_data, raw_tx, last_valid_block_height, lamports, status, submitted_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'sent', ?)",
+            (signature, user_id, trade_data, raw, last_valid_block_height, lamports, time.time())
+        )
+        conn.commit()
+        conn.close()
+        if not await self._broadcast(raw, priority):
+            conn = sqlite3.connect("bot.db")
+            c = conn.cursor()
+            c.execute("DELETE FROM trade_signatures WHERE signature = ?", (signature,))
+            conn.commit()
+            conn.close()
+            return None
+        self.pending[signature] = PendingTransaction(
+            user_id, trade_data, raw, last_valid_block_height, reservation, time.monotonic()
+        )
+        self._wake.set()
+        return signature
+
+    def restore(self) -> int:
+        conn = sqlite3.connect("bot.db")
+        c = conn.cursor()
+        c.execute(
+            "SELECT signature, user_id, trade_data, raw_tx, last_valid_block_height, lamports "
+            "FROM trade_signatures WHERE status = 'sent'"
+        )
+        rows = c.fetchall()
+        conn.close()
+        for signature, user_id, trade_data, raw, last_valid_block_height, lamports in rows:
+            # Held again until final: a fresh on-chain read does not include a trade that has not landed yet
+            reservation = balance_ledger.hold(user_id, lamports) if lamports else None
+            self.pending[signature] = PendingTransaction(
+                user_id, trade_data, raw, last_valid_block_height, reservation, 0.0
+            )
+        return len(rows)
+
+    async def _finalize(
+        self, signature: str, status: str, slot: Optional[int] = None, error: Optional[str] = None
+    ) -> None:
+        tx = self.pending.pop(signature, None)
+        if tx is None:
+            return
+        if tx.reservation is not None:
+            if status == "confirmed":
+                balance_ledger.settle(tx.reservation)
+            else:
+                balance_ledger.release(tx.reservation)
+        conn = sqlite3.connect("bot.db")
+        c = conn.cursor()
+        c.execute(
+            "UPDATE trade_signatures SET status = ?, slot = ?, error = ?, finalized_at = ?, raw_tx = NULL "
+            "WHERE signature = ?",
+            (status, slot, error, time.time(), signature)
+        )
+        if status == "confirmed":
+            c.execute("INSERT INTO trades (user_id, trade_data) VALUES (?, ?)", (tx.user_id, f"{tx.trade_data} tx: {signature}"))
+        conn.commit()
+        conn.close()
+        if status == "confirmed":
+            sessions.get(tx.user_id).recent_trades.append(tx.trade_data)
+            text = f"✅ Trade confirmed: {tx.trade_data}\nTx: {signature}"
+        elif status == "failed":
+            text = f"❌ Trade failed on-chain: {tx.trade_data}\nError: {error}\nTx: {signature}"
+        else:
+            text = f"⌛ Trade expired before landing: {tx.trade_data}\nTx: {signature}"
+        logger.info(f"Transaction {signature} for user {tx.user_id} {status}")
+        if application:
+            try:
+                await application.bot.send_message(chat_id=tx.user_id, text=text)
+            except Exception as e:
+                logger.error(f"Could not notify user {tx.user_id} about {signature}: {e!r}")
+
+    async def _check_statuses(self, signatures: List[str], search_history: bool = False) -> List[str]:
+        # Finalizes landed signatures and returns the ones with no status yet
+        unseen: List[str] = []
+        for i in range(0, len(signatures), 256):
+            batch = signatures[i:i + 256]
+            async with rate_limiter.limit(RPC_UPSTREAM, PRIORITY_TRADE):
+                response = await solana_client.get_signature_statuses(
+                    [Signature.from_string(sig) for sig in batch], search_transaction_history=search_history
+                )
+            for signature, status in zip(batch, response.value):
+                if status is None:
+                    unseen.append(signature)
+                elif status.err is not None:
+                    await self._finalize(signature, "failed", status.slot, str(status.err))
+                elif status.confirmation_status in (
+                    TransactionConfirmationStatus.Confirmed, TransactionConfirmationStatus.Finalized
+                ):
+                    await self._finalize(signature, "confirmed", status.slot)
+        return unseen
+
+    async def _poll(self) -> None:
+        # Block height is read before the statuses: a signature still unseen
+        # afterwards can no longer land once this height is past its limit
+        async with rate_limiter.limit(RPC_UPSTREAM, PRIORITY_TRADE):
+            block_height = (await solana_client.get_block_height(commitment=Confirmed)).value
+        unseen = await self._check_statuses(list(self.pending))
+        past_limit = [
+            sig for sig in unseen
+            if sig in self.pending and block_height > self.pending[sig].last_valid_block_height
+        ]
+        if past_limit:
+            # The default lookup only covers the recent status cache; a
+            # transaction that landed before a long downtime is only found
+            # in the ledger history
+            never_landed = set(await self._check_statuses(past_limit, search_history=True))
+            for signature in never_landed:
+                await self._finalize(signature, "expired")
+        now = time.monotonic()
+        resend = []
+        for signature in unseen:
+            tx = self.pending.get(signature)
+            if tx is None or block_height > tx.last_valid_block_height:
+                continue
+            if now - tx.last_sent >= TX_REBROADCAST_INTERVAL:
+                tx.last_sent = now
+                resend.append(tx.raw)
+        if resend:
+            await asyncio.gather(*(self._broadcast(raw, PRIORITY_BACKGROUND) for raw in resend))
+
+    async def run(self) -> None:
+        while True:
+            if not self.pending:
+                self._wake.clear()
+                await self._wake.wait()
+            await asyncio.sleep(TX_STATUS_POLL_INTERVAL)
+            try:
+                await self._poll()
+            except Exception as e:
+                logger.error(f"Transaction status poll failed: {e!r}")
+
+blockhash_cache = BlockhashCache()
+tx_pipeline = TransactionPipeline(blockhash_cache)
+
+# =============================================================================
+# 14. HELPER FUNCTIONS
+# =============================================================================
+async def get_sol_price(priority: int = PRIORITY_BACKGROUND) -> Optional[float]:
     cache_timeout = 60
-    if cache_key in user_settings.get(0, {}):
-        cached_price, timestamp = user_settings[0][cache_key]
+    latest = price_history.latest(SOL_PRICE_KEY)
+    if latest:
+        timestamp, cached_price = latest
         if time.time() - timestamp < cache_timeout:
             return cached_price
 
     async def fetch_coingecko():
         async with aiohttp.ClientSession() as session:
             try:
-                async with session.get(
-                    COINGECKO_URL,
-                    params={"ids": "solana", "vs_currencies": "usd"},
-                    timeout=aiohttp.ClientTimeout(total=5)
-                ) as resp:
-                    if resp.status == 429:
-                        raise aiohttp.ClientResponseError(
-                            resp.request_info, resp.history, status=429, message="Rate limit exceeded"
-                        )
-                    data = await resp.json()
-                    price = float(data.get("solana", {}).get("usd", 0))
-                    return price if 1 <= price <= 1000 else None
-            except (aiohttp.ClientError, ValueError) as e:
-                logger.error(f"CoinGecko error: {e}")
+                async with rate_limiter.limit("coingecko", priority, timeout=5):
+                    async with session.get(
+                        COINGECKO_URL,
+                        params={"ids": "solana", "vs_currencies": "usd"},
+                        timeout=aiohttp.ClientTimeout(total=5)
+                    ) as resp:
+                        if resp.status == 429:
+                            raise aiohttp.ClientResponseError(
+                                resp.request_info, resp.history, status=429,
+                                message="Rate limit exceeded", headers=resp.headers
+                            )
+                        data = await resp.json()
+                        price = float(data.get("solana", {}).get("usd", 0))
+                        return price if 1 <= price <= 1000 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error(f"CoinGecko error: {e!r}")
                 return None
 
     async def fetch_binance():
         async with aiohttp.ClientSession() as session:
             try:
-                async with session.get(
-                    "https://api.binance.com/api/v3/ticker/price",
-                    params={"symbol": "SOLUSDT"},
-                    timeout=aiohttp.ClientTimeout(total=5)
-                ) as resp:
-                    if resp.status == 429:
-                        raise aiohttp.ClientResponseError(
-                            resp.request_info, resp.history, status=429, message="Rate limit exceeded"
-                        )
-                    data = await resp.json()
-                    price = float(data.get("price", 0))
-                    return price if 1 <= price <= 1000 else None
-            except (aiohttp.ClientError, ValueError) as e:
-                logger.error(f"Binance error: {e}")
+                async with rate_limiter.limit("binance", priority, timeout=5):
+                    async with session.get(
+                        "https://api.binance.com/api/v3/ticker/price",
+                        params={"symbol": "SOLUSDT"},
+                        timeout=aiohttp.ClientTimeout(total=5)
+                    ) as resp:
+                        if resp.status == 429:
+                            raise aiohttp.ClientResponseError(
+                                resp.request_info, resp.history, status=429,
+                                message="Rate limit exceeded", headers=resp.headers
+                            )
+                        data = await resp.json()
+                        price = float(data.get("price", 0))
+                        return price if 1 <= price <= 1000 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error(f"Binance error: {e!r}")
                 return None
 
+    # 429 backoff is handled by rate_limiter; later attempts queue behind it
     for attempt in range(3):
         try:
             price = await fetch_coingecko()
             if price is not None:
-                async with orders_lock:
-                    user_settings.setdefault(0, {})[cache_key] = (price, time.time())
+                price_history.record(SOL_PRICE_KEY, price)
                 return price
             price = await fetch_binance()
             if price is not None:
-                async with orders_lock:
-                    user_settings.setdefault(0, {})[cache_key] = (price, time.time())
+                price_history.record(SOL_PRICE_KEY, price)
                 return price
-        except aiohttp.ClientResponseError as e:
-            if e.status == 429:
-                await asyncio.sleep(2 ** (attempt + 2))
-            else:
-                await asyncio.sleep(2 ** attempt)
         except Exception as e:
             logger.error(f"Price fetch attempt {attempt + 1} failed: {e}")
             await asyncio.sleep(2 ** attempt)
@@ -263,156 +1676,201 @@ async def get_sol_price() -> Optional[float]:
     logger.warning("All attempts to fetch SOL price failed")
     return None
 
-async def fetch_pool_id(token_address: str) -> Optional[str]:
+async def fetch_pool_id(token_address: str, priority: int = PRIORITY_TRADE) -> Optional[str]:
     async with aiohttp.ClientSession() as session:
         try:
-            async with session.get(
-                RAYDIUM_API_URL,
-                params={"mint1": token_address, "mint2": "So11111111111111111111111111111111111111112"},
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as resp:
-                data = await resp.json()
-                if data.get("success") and data.get("data", {}).get("data"):
-                    return data["data"]["data"][0].get("id")
+            async with rate_limiter.limit("raydium", priority):
+                async with session.get(
+                    RAYDIUM_API_URL,
+                    params={"mint1": token_address, "mint2": WSOL_MINT},
+                    timeout=aiohttp.ClientTimeout(total=10)
+                ) as resp:
+                    if resp.status == 429:
+                        raise aiohttp.ClientResponseError(
+                            resp.request_info, resp.history, status=429,
+                            message="Rate limit exceeded", headers=resp.headers
+                        )
+                    data = await resp.json()
+                    if data.get("success") and data.get("data", {}).get("data"):
+                        return data["data"]["data"][0].get("id")
         except aiohttp.ClientError as e:
             logger.error(f"Error fetching pool ID for {token_address}: {e}")
     return None
 
-async def execute_trade(user_id: int, token_address: str, amount: float, action: str = "buy") -> bool:
-    async with wallet_lock:
-        if user_id not in user_wallets:
-            wallet = load_wallet(user_id)
-            if not wallet:
-                logger.warning(f"Trade failed: No wallet for user {user_id}")
-                return False
-            user_wallets[user_id] = wallet
-        wallet = user_wallets[user_id]
+async def execute_trade(
+    user_id: int, token_address: str, amount: float, action: str = "buy", priority: int = PRIORITY_TRADE,
+    quote: Optional[Quote] = None, instructions: Optional[List[Instruction]] = None
+) -> bool:
+    wallet = await get_user_wallet(user_id)
+    if not wallet:
+        logger.warning(f"Trade failed: No wallet for user {user_id}")
+        return False
 
+    lamports = int(amount * 1e9)
+    reservation = None
     try:
-        balance_response = await solana_client.get_balance(wallet.public_key, commitment=Confirmed)
-        balance = balance_response.value / 1e9 if balance_response.value else 0
-        if balance < amount:
-            logger.warning(f"Insufficient funds for user {user_id}: {balance} SOL < {amount} SOL")
+        fresh = await balance_ledger.ensure(user_id, wallet.public_key, priority)
+        reservation = balance_ledger.reserve(user_id, lamports)
+        if reservation is None and not fresh:
+            # The cached balance may predate a deposit; re-read it once before rejecting
+            await balance_ledger.refresh(user_id, wallet.public_key, priority)
+            reservation = balance_ledger.reserve(user_id, lamports)
+        if reservation is None:
+            available = (balance_ledger.available(user_id) or 0) / 1e9
+            logger.warning(f"Insufficient funds for user {user_id}: {available} SOL available < {amount} SOL")
             return False
 
-        pool_id = await fetch_pool_id(token_address)
-        if not pool_id:
-            logger.error(f"No pool ID found for {token_address}")
-            return False
+        pool = pool_cache.get(token_address)
+        if pool is not None and (pool.kind == "raydium" or not pool.complete):
+            pool_id = pool.address
+        else:
+            pool_id = await fetch_pool_id(token_address, priority)
+            if not pool_id:
+                logger.error(f"No pool ID found for {token_address}")
+                return False
+            if pool is None or pool.kind == "pump":
+                await pool_cache.track_raydium(token_address, pool_id, priority)
 
         async with orders_lock:
-            slippage = user_settings.get(user_id, {}).get("slippage", 0.5)
-        logger.info(f"Applying slippage: {slippage}% for {action} trade")
+            slippage = sessions.get(user_id).settings.get("slippage", DEFAULT_SLIPPAGE)
+        if quote is None:
+            quote = pool_cache.quote(token_address, action, lamports, slippage)
+        if quote:
+            logger.info(
+                f"Applying slippage: {slippage}% for {action} trade, expected out {quote.expected_out}, "
+                f"min out {quote.min_out}, impact {quote.price_impact:.2f}%"
+            )
+        else:
+            logger.info(f"Applying slippage: {slippage}% for {action} trade (no pool quote for {token_address})")
+
+        trade_data = f"{action.upper()} {amount} SOL for {token_address} (slippage: {slippage}%)"
+        if quote:
+            trade_data += f" min out: {quote.min_out}"
+        if instructions:
+            signature = await tx_pipeline.submit(user_id, wallet, instructions, trade_data, reservation, priority)
+            if signature is None:
+                logger.error(f"No RPC endpoint accepted the {action} transaction for user {user_id}")
+                return False
+            # The pipeline settles or releases the reservation once the signature is final
+            reservation = None
+            logger.info(f"Sent {action} of {amount} SOL for token {token_address} on pool {pool_id}: {signature}")
+            return True
 
         logger.info(f"Simulated {action} of {amount} SOL for token {token_address} on pool {pool_id}")
         async with orders_lock:
-            trade_data = f"{action.upper()} {amount} SOL for {token_address} (slippage: {slippage}%)"
-            trades.setdefault(user_id, []).append(trade_data)
+            sessions.get(user_id).recent_trades.append(trade_data)
             conn = sqlite3.connect("bot.db")
             c = conn.cursor()
             c.execute("INSERT INTO trades (user_id, trade_data) VALUES (?, ?)", (user_id, trade_data))
             conn.commit()
             conn.close()
+        balance_ledger.settle(reservation)
         return True
     except RPCException as e:
         logger.error(f"RPC error in trade for user {user_id}: {e}")
         return False
     except Exception as e:
-        logger.error(f"Trade execution failed for user {user_id}: {e}\n{traceback.format_exc()}")
+        logger.error(f"Trade execution failed for user {user_id}: {e}", exc_info=True)
         return False
+    finally:
+        # No-op once the reservation has been settled
+        if reservation is not None:
+            balance_ledger.release(reservation)
 
 async def process_wallet_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     text = update.message.text.strip()
 
-    if connection_attempts.get(user_id, 0) >= 3:
+    session = sessions.get(user_id)
+    if session.connection_attempts >= 3:
         await update.message.reply_text("❌ Too many attempts. Try again later.")
         return
 
-    connection_attempts[user_id] = connection_attempts.get(user_id, 0) + 1
+    session.connection_attempts += 1
     await update.message.reply_text("🔄 Connecting wallet...")
 
     try:
-        async with wallet_lock:
-            keypair = None
-            if " " in text:
-                mnemonic_words = text.split()
-                if len(mnemonic_words) not in [12, 24]:
-                    await update.message.reply_text("❌ Invalid mnemonic: Must be 12 or 24 words.")
-                    return
-                try:
-                    seed_bytes = Bip39SeedGenerator(text).Generate()
-                    bip44_ctx = Bip44.FromSeed(seed_bytes, Bip44Coins.SOLANA).DeriveDefaultPath()
-                    keypair = Keypair.from_bytes(bip44_ctx.PrivateKey().Raw().ToBytes())
-                except Exception as e:
-                    logger.error(f"Mnemonic processing error for user {user_id}: {e}")
-                    await update.message.reply_text("❌ Invalid mnemonic phrase.")
-                    return
-            else:
-                try:
-                    if text.startswith('['):
-                        key_bytes = bytes(json.loads(text))
-                    else:
-                        try:
-                            key_bytes = base58.b58decode(text)
-                        except ValueError:
-                            key_bytes = bytes.fromhex(text)
-                    if len(key_bytes) == 64:
-                        keypair = Keypair.from_bytes(key_bytes)
-                    elif len(key_bytes) == 32:
-                        keypair = Keypair.from_seed(key_bytes)
-                    else:
-                        await update.message.reply_text("❌ Invalid key length.")
-                        return
-                except Exception as e:
-                    logger.error(f"Private key processing error for user {user_id}: {e}")
-                    await update.message.reply_text("❌ Invalid private key format.")
+        keypair = None
+        if " " in text:
+            mnemonic_words = text.split()
+            if len(mnemonic_words) not in [12, 24]:
+                await update.message.reply_text("❌ Invalid mnemonic: Must be 12 or 24 words.")
+                return
+            try:
+                keypair = await run_crypto(derive_keypair, text)
+            except Exception as e:
+                logger.error(f"Mnemonic processing error for user {user_id}: {e}")
+                await update.message.reply_text("❌ Invalid mnemonic phrase.")
+                return
+        else:
+            try:
+                if text.startswith('['):
+                    key_bytes = bytes(json.loads(text))
+                else:
+                    try:
+                        key_bytes = base58.b58decode(text)
+                    except ValueError:
+                        key_bytes = bytes.fromhex(text)
+                if len(key_bytes) == 64:
+                    keypair = Keypair.from_bytes(key_bytes)
+                elif len(key_bytes) == 32:
+                    keypair = Keypair.from_seed(key_bytes)
+                else:
+                    await update.message.reply_text("❌ Invalid key length.")
                     return
+            except Exception as e:
+                logger.error(f"Private key processing error for user {user_id}: {e}")
+                await update.message.reply_text("❌ Invalid private key format.")
+                return
 
-            for attempt in range(3):
-                try:
+        for attempt in range(3):
+            try:
+                async with rate_limiter.limit(RPC_UPSTREAM, PRIORITY_TRADE):
                     balance_response = await solana_client.get_balance(keypair.public_key, commitment=Confirmed)
-                    if balance_response.value is None:
-                        raise ValueError("Received None balance")
-                    balance_sol = balance_response.value / 1e9
-                    user_wallets[user_id] = keypair
-                    store_wallet(user_id, keypair)
-                    await update.message.reply_text(
-                        f"✅ Wallet Connected!\nAddress: {keypair.public_key}\nBalance: {balance_sol:.4f} SOL"
-                    )
-                    logger.info(f"Wallet connected for user {user_id}: {keypair.public_key}, Balance: {balance_sol:.4f} SOL")
-                    connection_attempts[user_id] = 0
+                if balance_response.value is None:
+                    raise ValueError("Received None balance")
+                break
+            except RPCException as e:
+                logger.warning(f"Balance check attempt {attempt + 1} failed for user {user_id}: {e}")
+                if attempt < 2:
+                    await asyncio.sleep(2 ** (attempt + 1))
+                else:
+                    await update.message.reply_text("❌ Unable to verify wallet balance.")
                     return
-                except RPCException as e:
-                    logger.warning(f"Balance check attempt {attempt + 1} failed for user {user_id}: {e}")
-                    if attempt < 2:
-                        await asyncio.sleep(2 ** (attempt + 1))
-                    else:
-                        await update.message.reply_text("❌ Unable to verify wallet balance.")
-                        return
+        async with user_wallet_lock(user_id):
+            balance_ledger.observe(user_id, keypair.public_key, balance_response.value)
+            session.wallet = keypair
+            await run_crypto(store_wallet, user_id, keypair)
+        balance_sol = balance_response.value / 1e9
+        await update.message.reply_text(
+            f"✅ Wallet Connected!\nAddress: {keypair.public_key}\nBalance: {balance_sol:.4f} SOL"
+        )
+        logger.info(f"Wallet connected for user {user_id}: {keypair.public_key}, Balance: {balance_sol:.4f} SOL")
+        session.connection_attempts = 0
     except Exception as e:
-        logger.error(f"Wallet connection error for user {user_id}: {e}\n{traceback.format_exc()}")
+        logger.error(f"Wallet connection error for user {user_id}: {e}", exc_info=True)
         await update.message.reply_text("❌ Connection failed. Try /wallet again.")
 
 # =============================================================================
-# 9. COMMAND HANDLERS
+# 15. COMMAND HANDLERS
 # =============================================================================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     sol_price = await get_sol_price()
     user_id = update.effective_user.id
     wallet_info = "💳 Your Wallet\n      ↳ Not connected. Use /wallet to connect."
     
-    async with wallet_lock:
-        if user_id in user_wallets or load_wallet(user_id):
-            wallet = user_wallets.get(user_id) or load_wallet(user_id)
-            user_wallets[user_id] = wallet
-            try:
+    wallet = await get_user_wallet(user_id)
+    if wallet:
+        try:
+            async with rate_limiter.limit(RPC_UPSTREAM, PRIORITY_BACKGROUND):
                 balance_response = await solana_client.get_balance(wallet.public_key, commitment=Confirmed)
-                balance = balance_response.value / 1e9 if balance_response.value else 0
-                wallet_info = f"💳 Your Wallet\n      ↳ {wallet.public_key}\n      ↳ Balance: {balance:.4f} SOL"
-            except RPCException as e:
-                logger.error(f"Error retrieving balance for user {user_id}: {e}")
-                wallet_info = f"💳 Your Wallet\n      ↳ {wallet.public_key}\n      ↳ Balance: Error"
+            if balance_response.value is not None:
+                balance_ledger.observe(user_id, wallet.public_key, balance_response.value)
+            balance = balance_response.value / 1e9 if balance_response.value else 0
+            wallet_info = f"💳 Your Wallet\n      ↳ {wallet.public_key}\n      ↳ Balance: {balance:.4f} SOL"
+        except RPCException as e:
+            logger.error(f"Error retrieving balance for user {user_id}: {e}")
+            wallet_info = f"💳 Your Wallet\n      ↳ {wallet.public_key}\n      ↳ Balance: Error"
 
     price_display = f"💰 SOL Price: ${sol_price:.2f}" if sol_price is not None else "💰 SOL Price: Unavailable"
     message = (
@@ -445,7 +1903,7 @@ async def wallet_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         "🔒 Or use /uploadkey to upload a file."
     )
     async with orders_lock:
-        pending_wallet[user_id] = True
+        sessions.get(user_id).pending_wallet = True
 
 async def uploadkey(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -454,18 +1912,17 @@ async def uploadkey(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "⚠️ Ensure the file is sent in a PRIVATE chat!"
     )
     async with orders_lock:
-        pending_orders[user_id] = {"action": "upload_key"}
+        set_pending_order(user_id, {"action": "upload_key"})
     asyncio.create_task(clear_pending_order(user_id))
 
 async def buysell(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    async with wallet_lock:
-        if user_id not in user_wallets and not load_wallet(user_id):
-            await update.message.reply_text("❌ Please connect your wallet first using /wallet")
-            return
+    if not await get_user_wallet(user_id):
+        await update.message.reply_text("❌ Please connect your wallet first using /wallet")
+        return
     await update.message.reply_text("🔄 Enter token address and amount (e.g., TOKEN_ADDRESS, 1.0):")
     async with orders_lock:
-        pending_orders[user_id] = {"action": "trade", "step": "details"}
+        set_pending_order(user_id, {"action": "trade", "step": "details"})
     asyncio.create_task(clear_pending_order(user_id))
 
 async def sniper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -477,19 +1934,57 @@ async def sniper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def sniperpump(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.callback_query.from_user.id
-    async with wallet_lock:
-        if user_id not in user_wallets and not load_wallet(user_id):
-            await update.callback_query.answer("❌ Connect your wallet first using /wallet", show_alert=True)
-            return
+    if not await get_user_wallet(user_id):
+        await update.callback_query.answer("❌ Connect your wallet first using /wallet", show_alert=True)
+        return
     async with orders_lock:
-        active_snipers.setdefault(user_id, []).append("pump")
+        added = snipe_rules.add(SnipeRule(user_id=user_id, amount=DEFAULT_SNIPE_AMOUNT))
+        if added:
+            state_journal.record("snipe_rules", user_id, snipe_rules.dump_user(user_id))
+    if not added:
+        await update.callback_query.answer("ℹ️ Pump.fun sniper already active")
+        return
     await update.callback_query.answer("✅ Pump.fun sniper activated!")
     logger.info(f"Pump.fun sniper activated for user {user_id}")
 
+async def snipe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text(
+            "🎯 Usage: /snipe <AMOUNT> [creator=ADDRESS] [name=WORD] [minliq=SOL] [maxliq=SOL] [minmc=SOL] [maxmc=SOL]\n"
+            "Example: /snipe 0.5 name=pepe minliq=30"
+        )
+        return
+    try:
+        rule = parse_snipe_rule(user_id, context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Invalid snipe rule: {e}")
+        return
+    if not await get_user_wallet(user_id):
+        await update.message.reply_text("❌ Connect your wallet first using /wallet")
+        return
+    async with orders_lock:
+        added = snipe_rules.add(rule)
+        if added:
+            state_journal.record("snipe_rules", user_id, snipe_rules.dump_user(user_id))
+    if not added:
+        await update.message.reply_text("ℹ️ This snipe rule is already active")
+        return
+    await update.message.reply_text(f"✅ Snipe rule added: {rule.describe()}")
+    logger.info(f"Snipe rule added for user {user_id}: {rule.describe()}")
+
+async def stopsnipe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    async with orders_lock:
+        removed = snipe_rules.remove_user(user_id)
+        if removed:
+            state_journal.record("snipe_rules", user_id, None)
+    await update.message.reply_text(f"🛑 Removed {removed} snipe rule(s)")
+
 async def listallsniperpump(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     async with orders_lock:
-        active = active_snipers.get(user_id, [])
+        active = [rule.describe() for rule in snipe_rules.rules_for(user_id)]
     await update.message.reply_text(f"🔍 Active Snipers: {', '.join(active) if active else 'None'}")
 
 async def limitorders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -514,12 +2009,12 @@ async def createdca(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if amount <= 0 or interval <= 0:
             await update.message.reply_text("❌ Amount and interval must be positive")
             return
-        async with wallet_lock:
-            if user_id not in user_wallets and not load_wallet(user_id):
-                await update.message.reply_text("❌ Connect your wallet first using /wallet")
-                return
+        if not await get_user_wallet(user_id):
+            await update.message.reply_text("❌ Connect your wallet first using /wallet")
+            return
         async with orders_lock:
             dca_orders.setdefault(user_id, []).append({"token": token, "amount": amount, "interval": interval})
+            state_journal.record("dca_orders", user_id, dca_orders[user_id])
         await update.message.reply_text(f"✅ DCA order created: {amount} {token} every {interval} seconds")
         asyncio.create_task(schedule_dca(user_id, token, amount, interval))
         logger.info(f"DCA order created for user {user_id}: {amount} {token} every {interval}s")
@@ -543,23 +2038,24 @@ async def schedule_dca(user_id: int, token: str, amount: float, interval: int) -
 
 async def copytrade(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    async with wallet_lock:
-        if user_id not in user_wallets and not load_wallet(user_id):
-            await update.message.reply_text("❌ Connect your wallet first using /wallet")
-            return
+    if not await get_user_wallet(user_id):
+        await update.message.reply_text("❌ Connect your wallet first using /wallet")
+        return
     await update.message.reply_text("👥 Enter trader's address to copy:")
     async with orders_lock:
-        pending_orders[user_id] = {"action": "copytrade", "step": "address"}
+        set_pending_order(user_id, {"action": "copytrade", "step": "address"})
     asyncio.create_task(clear_pending_order(user_id))
 
 async def monitor_trader(user_id: int, trader_address: str) -> None:
     try:
         trader_pubkey = Pubkey.from_string(trader_address)
         while True:
-            signatures = await solana_client.get_signatures_for_address(trader_pubkey, limit=1)
+            async with rate_limiter.limit(RPC_UPSTREAM, PRIORITY_BACKGROUND):
+                signatures = await solana_client.get_signatures_for_address(trader_pubkey, limit=1)
             if signatures.value:
                 sig = signatures.value[0].signature
-                tx = await solana_client.get_transaction(sig)
+                async with rate_limiter.limit(RPC_UPSTREAM, PRIORITY_BACKGROUND):
+                    tx = await solana_client.get_transaction(sig)
                 if tx.value and "swap" in str(tx.value):
                     success = await execute_trade(user_id, "TOKEN_ADDRESS", 1.0, "buy")
                     if success:
@@ -569,22 +2065,31 @@ async def monitor_trader(user_id: int, trader_address: str) -> None:
                             logger.error(f"Error sending copy trade confirmation to user {user_id}: {e}")
             await asyncio.sleep(60)
     except Exception as e:
-        logger.error(f"Copy trading error for user {user_id}: {e}\n{traceback.format_exc()}")
+        logger.error(f"Copy trading error for user {user_id}: {e}", exc_info=True)
+
+def start_copy_trader(user_id: int, trader_address: str) -> bool:
+    # A monitor that died on an error stays in copy_traders; entering the address again restarts it
+    task = copy_tasks.get((user_id, trader_address))
+    if task is not None and not task.done():
+        return False
+    copy_tasks[(user_id, trader_address)] = asyncio.create_task(monitor_trader(user_id, trader_address))
+    return True
 
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    async with wallet_lock:
-        if user_id not in user_wallets and not load_wallet(user_id):
-            await update.message.reply_text("❌ No wallet connected. Use /wallet to connect.")
-            return
-        wallet = user_wallets.get(user_id) or load_wallet(user_id)
-        user_wallets[user_id] = wallet
-        try:
+    wallet = await get_user_wallet(user_id)
+    if not wallet:
+        await update.message.reply_text("❌ No wallet connected. Use /wallet to connect.")
+        return
+    try:
+        async with rate_limiter.limit(RPC_UPSTREAM, PRIORITY_BACKGROUND):
             balance_response = await solana_client.get_balance(wallet.public_key, commitment=Confirmed)
-            balance = balance_response.value / 1e9 if balance_response.value else 0
-        except RPCException as e:
-            logger.error(f"Error retrieving balance for user {user_id}: {e}")
-            balance = 0
+        if balance_response.value is not None:
+            balance_ledger.observe(user_id, wallet.public_key, balance_response.value)
+        balance = balance_response.value / 1e9 if balance_response.value else 0
+    except RPCException as e:
+        logger.error(f"Error retrieving balance for user {user_id}: {e}")
+        balance = 0
 
     async with orders_lock:
         conn = sqlite3.connect("bot.db")
@@ -619,7 +2124,7 @@ async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     ref_code = f"REF-{str(user_id)[-6:].zfill(6)}"
     async with orders_lock:
-        referrals[user_id] = ref_code
+        sessions.get(user_id).referral = ref_code
     await update.message.reply_text(f"📨 Referral Code: {ref_code}")
 
 async def backupbots(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -628,8 +2133,7 @@ async def backupbots(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 async def exportsettings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     async with orders_lock:
-        settings = user_settings.get(user_id, {})
-        settings_str = json.dumps(settings, indent=2)
+        settings_str = json.dumps(sessions.get(user_id).settings, indent=2)
     await update.message.reply_text(
         f"📥 Your settings:\n```json\n{settings_str}\n```\nSave this securely!", parse_mode="Markdown"
     )
@@ -647,7 +2151,7 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "1. **Connect Wallet**: Use /wallet or 'Connect Wallet' button.\n"
         "2. **Generate Wallet**: Use 'Generate Wallet' button.\n"
         "3. **Start Trading**: Use /buysell. Example: `/buysell TOKEN_ADDRESS, 1.0`\n"
-        "4. **Snipe Tokens**: Use /sniper for Pump.fun.\n"
+        "4. **Snipe Tokens**: Use /sniper for Pump.fun, or /snipe to add filtered rules. /stopsnipe clears them.\n"
         "5. **Limit Orders**: Use /limitorders.\n"
         "6. **DCA**: Use /createdca. Example: `/createdca SOL 0.1 3600`\n"
         "7. **Copy Trade**: Use /copytrade.\n"
@@ -659,15 +2163,15 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text(help_message)
 
 # =============================================================================
-# 10. CALLBACK QUERY ROUTER
+# 16. CALLBACK QUERY ROUTER
 # =============================================================================
 async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     data = update.callback_query.data
     user_id = update.callback_query.from_user.id
 
+    session = sessions.get(user_id)
     async with orders_lock:
-        user_settings.setdefault(user_id, {})
-        store_settings(user_id, user_settings[user_id])
+        store_settings(user_id, session.settings)
 
     handlers = {
         "wallet": lambda: wallet_prompt(update, context),
@@ -692,51 +2196,52 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await handlers[data]()
         if data in ["create_limit", "modify_limit", "slippage"]:
             async with orders_lock:
-                pending_orders[user_id] = {"action": data}
+                set_pending_order(user_id, {"action": data})
             asyncio.create_task(clear_pending_order(user_id))
         await update.callback_query.answer()
     elif data == "autobuy":
         async with orders_lock:
-            user_settings[user_id]["autobuy"] = not user_settings[user_id].get("autobuy", False)
-            store_settings(user_id, user_settings[user_id])
+            session.settings["autobuy"] = not session.settings.get("autobuy", False)
+            store_settings(user_id, session.settings)
         await update.callback_query.answer(
-            f"Auto Buy {'enabled' if user_settings[user_id]['autobuy'] else 'disabled'}"
+            f"Auto Buy {'enabled' if session.settings['autobuy'] else 'disabled'}"
         )
     elif data == "autosell":
         async with orders_lock:
-            user_settings[user_id]["autosell"] = not user_settings[user_id].get("autosell", False)
-            store_settings(user_id, user_settings[user_id])
+            session.settings["autosell"] = not session.settings.get("autosell", False)
+            store_settings(user_id, session.settings)
         await update.callback_query.answer(
-            f"Auto Sell {'enabled' if user_settings[user_id]['autosell'] else 'disabled'}"
+            f"Auto Sell {'enabled' if session.settings['autosell'] else 'disabled'}"
         )
     elif data == "slippage":
         await context.bot.send_message(chat_id=user_id, text="📉 Enter slippage percentage (e.g., 0.5):")
         async with orders_lock:
-            pending_orders[user_id] = {"action": "set_slippage"}
+            set_pending_order(user_id, {"action": "set_slippage"})
         await update.callback_query.answer()
         asyncio.create_task(clear_pending_order(user_id))
     elif data.startswith("lang_"):
         lang = data.split("_")[1]
         async with orders_lock:
-            user_settings[user_id]["language"] = lang
-            store_settings(user_id, user_settings[user_id])
+            session.settings["language"] = lang
+            store_settings(user_id, session.settings)
         await update.callback_query.answer(f"Language set to {lang}")
 
 # =============================================================================
-# 11. PENDING INPUT HANDLER
+# 17. PENDING INPUT HANDLER
 # =============================================================================
 async def pending_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     text = update.message.text.strip()
 
+    session = sessions.get(user_id)
     async with orders_lock:
-        if user_id in pending_wallet:
+        if session.pending_wallet:
             await process_wallet_key(update, context)
-            del pending_wallet[user_id]
+            session.pending_wallet = False
             return
-        if user_id not in pending_orders:
+        if session.pending_order is None:
             return
-        order = pending_orders[user_id]
+        order = session.pending_order
 
     if order["action"] == "trade":
         try:
@@ -752,12 +2257,11 @@ async def pending_input_handler(update: Update, context: ContextTypes.DEFAULT_TY
             success = await execute_trade(user_id, token_address.strip(), amount, "buy")
             await update.message.reply_text("✅ Trade executed" if success else "❌ Trade failed")
             async with orders_lock:
-                if user_id in pending_orders:
-                    del pending_orders[user_id]
+                drop_pending_order(user_id)
         except ValueError:
             await update.message.reply_text("❌ Invalid input format: Use TOKEN_ADDRESS, AMOUNT")
         except Exception as e:
-            logger.error(f"Trade input error for user {user_id}: {e}\n{traceback.format_exc()}")
+            logger.error(f"Trade input error for user {user_id}: {e}", exc_info=True)
             await update.message.reply_text(f"❌ Error: {e}")
     elif order["action"] in ["create_limit", "modify_limit"]:
         try:
@@ -776,12 +2280,12 @@ async def pending_input_handler(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text(f"✅ Limit order {'created' if order['action'] == 'create_limit' else 'modified'}")
             async with orders_lock:
                 limit_orders[user_id] = order_data
-                if user_id in pending_orders:
-                    del pending_orders[user_id]
+                state_journal.record("limit_orders", user_id, order_data)
+                drop_pending_order(user_id)
         except ValueError:
             await update.message.reply_text("❌ Invalid format: Use TOKEN, PRICE, QUANTITY")
         except Exception as e:
-            logger.error(f"Limit order error for user {user_id}: {e}\n{traceback.format_exc()}")
+            logger.error(f"Limit order error for user {user_id}: {e}", exc_info=True)
             await update.message.reply_text(f"❌ Error: {e}")
     elif order["action"] == "set_slippage":
         try:
@@ -790,84 +2294,884 @@ async def pending_input_handler(update: Update, context: ContextTypes.DEFAULT_TY
                 await update.message.reply_text("❌ Slippage must be non-negative")
                 return
             async with orders_lock:
-                user_settings[user_id]["slippage"] = slippage
-                store_settings(user_id, user_settings[user_id])
-                if user_id in pending_orders:
-                    del pending_orders[user_id]
+                session.settings["slippage"] = slippage
+                store_settings(user_id, session.settings)
+                drop_pending_order(user_id)
             await update.message.reply_text(f"✅ Slippage set to {slippage}%")
         except ValueError:
             await update.message.reply_text("❌ Invalid slippage format. Use a number (e.g., 0.5)")
         except Exception as e:
-            logger.error(f"Slippage setting error for user {user_id}: {e}\n{traceback.format_exc()}")
+            logger.error(f"Slippage setting error for user {user_id}: {e}", exc_info=True)
             await update.message.reply_text(f"❌ Error: {e}")
     elif order["action"] == "copytrade":
         try:
             trader_address = text
             Pubkey.from_string(trader_address)
             async with orders_lock:
-                trades.setdefault(user_id, []).append(f"Copying {trader_address}")
-                if user_id in pending_orders:
-                    del pending_orders[user_id]
+                session.recent_trades.append(f"Copying {trader_address}")
+                drop_pending_order(user_id)
+                if trader_address not in copy_traders.get(user_id, []):
+                    copy_traders.setdefault(user_id, []).append(trader_address)
+                    state_journal.record("copy_traders", user_id, copy_traders[user_id])
+                start_copy_trader(user_id, trader_address)
             await update.message.reply_text(f"✅ Copy trading activated for {trader_address}")
-            asyncio.create_task(monitor_trader(user_id, trader_address))
         except Exception as e:
-            logger.error(f"Copy trade setup error for user {user_id}: {e}\n{traceback.format_exc()}")
+            logger.error(f"Copy trade setup error for user {user_id}: {e}", exc_info=True)
             await update.message.reply_text("❌ Invalid trader address")
     elif order["action"] == "upload_key":
         await update.message.reply_text("❌ File upload not implemented. Paste the key directly.")
         async with orders_lock:
-            if user_id in pending_orders:
-                del pending_orders[user_id]
+            drop_pending_order(user_id)
 
 # =============================================================================
-# 12. WEBSOCKET MONITORING
+# 18. SNIPE RULES
 # =============================================================================
+NAME_WORD = re.compile(r"\w+")
+
+@dataclass(frozen=True)
+class SnipeRule:
+    user_id: int
+    amount: float
+    creator: Optional[str] = None
+    name_keyword: Optional[str] = None
+    min_liquidity: float = 0.0
+    max_liquidity: Optional[float] = None
+    min_market_cap: float = 0.0
+    max_market_cap: Optional[float] = None
+
+    def matches(self, event: "PoolEvent") -> bool:
+        return (
+            (self.creator is None or event.creator == self.creator)
+            and (self.name_keyword is None or self.name_keyword in event.words)
+            and event.liquidity >= self.min_liquidity
+            and (self.max_liquidity is None or event.liquidity <= self.max_liquidity)
+            and event.market_cap >= self.min_market_cap
+            and (self.max_market_cap is None or event.market_cap <= self.max_market_cap)
+        )
+
+    def describe(self) -> str:
+        parts = [f"{self.amount} SOL"]
+        if self.creator:
+            parts.append(f"creator={self.creator}")
+        if self.name_keyword:
+            parts.append(f"name={self.name_keyword}")
+        if self.min_liquidity:
+            parts.append(f"minliq={self.min_liquidity}")
+        if self.max_liquidity is not None:
+            parts.append(f"maxliq={self.max_liquidity}")
+        if self.min_market_cap:
+            parts.append(f"minmc={self.min_market_cap}")
+        if self.max_market_cap is not None:
+            parts.append(f"maxmc={self.max_market_cap}")
+        return " ".join(parts)
+
+@dataclass(frozen=True)
+class PoolEvent:
+    token: str
+    creator: Optional[str]
+    words: frozenset
+    liquidity: float
+    market_cap: float
+
+def parse_pool_event(data: Dict[str, Any]) -> Optional[PoolEvent]:
+    token = data.get("token") or data.get("mint")
+    if not token:
+        return None
+    name = f"{data.get('name') or ''} {data.get('symbol') or ''}"
+    try:
+        return PoolEvent(
+            token=token,
+            creator=data.get("creator") or data.get("traderPublicKey"),
+            words=frozenset(NAME_WORD.findall(name.lower())),
+            liquidity=float(data.get("liquidity") or data.get("vSolInBondingCurve") or 0),
+            market_cap=float(data.get("market_cap") or data.get("marketCapSol") or 0),
+        )
+    except (TypeError, ValueError) as e:
+        logger.error(f"Malformed pool event for {token}: {e}")
+        return None
+
+def parse_snipe_rule(user_id: int, args: List[str]) -> SnipeRule:
+    amount = float(args[0])
+    if amount <= 0:
+        raise ValueError("amount must be positive")
+    fields: Dict[str, Any] = {}
+    numeric = {"minliq": "min_liquidity", "maxliq": "max_liquidity", "minmc": "min_market_cap", "maxmc": "max_market_cap"}
+    for arg in args[1:]:
+        key, sep, value = arg.partition("=")
+        key = key.lower()
+        if not sep or not value:
+            raise ValueError(f"expected key=value, got '{arg}'")
+        if key == "creator":
+            Pubkey.from_string(value)
+            fields["creator"] = value
+        elif key == "name":
+            # Names are matched word by word, so the keyword must be a single word
+            if not NAME_WORD.fullmatch(value):
+                raise ValueError(f"name must be a single word (letters, digits or _), got '{value}'")
+            fields["name_keyword"] = value.lower()
+        elif key in numeric:
+            number = float(value)
+            if number < 0:
+                raise ValueError(f"{key} must be non-negative")
+            fields[numeric[key]] = number
+        else:
+            raise ValueError(f"unknown filter '{key}'")
+    return SnipeRule(user_id=user_id, amount=amount, **fields)
+
+class SnipeRuleEngine:
+    # Each rule lives in exactly one index, chosen by its most selective filter:
+    # creator (exact), name keyword (exact word), then liquidity or market cap
+    # floors (sorted, bisected). Matching an event only visits the buckets it
+    # can hit and verifies those candidates with SnipeRule.matches.
+    def __init__(self):
+        self._rules: Dict[SnipeRule, None] = {}
+        self._by_user: Dict[int, Dict[SnipeRule, None]] = {}
+        self._by_creator: Dict[str, Dict[SnipeRule, None]] = {}
+        self._by_keyword: Dict[str, Dict[SnipeRule, None]] = {}
+        self._liquidity_floors: List[float] = []
+        self._liquidity_rules: List[SnipeRule] = []
+        self._market_cap_floors: List[float] = []
+        self._market_cap_rules: List[SnipeRule] = []
+        self._unindexed: Dict[SnipeRule, None] = {}
+
+    def _index(self, rule: SnipeRule) -> None:
+        self._by_user.setdefault(rule.user_id, {})[rule] = None
+        if rule.creator is not None:
+            self._by_creator.setdefault(rule.creator, {})[rule] = None
+        elif rule.name_keyword is not None:
+            self._by_keyword.setdefault(rule.name_keyword, {})[rule] = None
+        elif rule.min_liquidity > 0:
+            pos = bisect.bisect_right(self._liquidity_floors, rule.min_liquidity)
+            self._liquidity_floors.insert(pos, rule.min_liquidity)
+            self._liquidity_rules.insert(pos, rule)
+        elif rule.min_market_cap > 0:
+            pos = bisect.bisect_right(self._market_cap_floors, rule.min_market_cap)
+            self._market_cap_floors.insert(pos, rule.min_market_cap)
+            self._market_cap_rules.insert(pos, rule)
+        else:
+            self._unindexed[rule] = None
+
+    @staticmethod
+    def _drop_bucketed(buckets: Dict[str, Dict[SnipeRule, None]], key: str, rule: SnipeRule) -> None:
+        bucket = buckets[key]
+        del bucket[rule]
+        if not bucket:
+            del buckets[key]
+
+    @staticmethod
+    def _drop_sorted(floors: List[float], rules: List[SnipeRule], floor: float, rule: SnipeRule) -> None:
+        lo = bisect.bisect_left(floors, floor)
+        hi = bisect.bisect_right(floors, floor, lo)
+        pos = rules.index(rule, lo, hi)
+        del floors[pos]
+        del rules[pos]
+
+    def _unindex(self, rule: SnipeRule) -> None:
+        if rule.creator is not None:
+            self._drop_bucketed(self._by_creator, rule.creator, rule)
+        elif rule.name_keyword is not None:
+            self._drop_bucketed(self._by_keyword, rule.name_keyword, rule)
+        elif rule.min_liquidity > 0:
+            self._drop_sorted(self._liquidity_floors, self._liquidity_rules, rule.min_liquidity, rule)
+        elif rule.min_market_cap > 0:
+            self._drop_sorted(self._market_cap_floors, self._market_cap_rules, rule.min_market_cap, rule)
+        else:
+            del self._unindexed[rule]
+
+    def add(self, rule: SnipeRule) -> bool:
+        if rule in self._rules:
+            return False
+        self._rules[rule] = None
+        self._index(rule)
+        return True
+
+    def remove_user(self, user_id: int) -> int:
+        removed = self._by_user.pop(user_id, {})
+        for rule in removed:
+            del self._rules[rule]
+            self._unindex(rule)
+        return len(removed)
+
+    def all_rules(self) -> List[SnipeRule]:
+        return list(self._rules)
+
+    def rules_for(self, user_id: int) -> List[SnipeRule]:
+        return list(self._by_user.get(user_id, []))
+
+    def dump_user(self, user_id: int) -> List[Dict[str, Any]]:
+        return [asdict(rule) for rule in self._by_user.get(user_id, [])]
+
+    def dump_all(self) -> Dict[int, List[Dict[str, Any]]]:
+        return {user_id: self.dump_user(user_id) for user_id in self._by_user}
+
+    def load_user(self, user_id: int, rules: Optional[List[Dict[str, Any]]]) -> None:
+        self.remove_user(user_id)
+        for rule in rules or []:
+            self.add(SnipeRule(**rule))
+
+    def _candidates(self, event: PoolEvent):
+        if event.creator is not None:
+            yield from self._by_creator.get(event.creator, ())
+        for word in event.words:
+            yield from self._by_keyword.get(word, ())
+        end = bisect.bisect_right(self._liquidity_floors, event.liquidity)
+        yield from self._liquidity_rules[:end]
+        end = bisect.bisect_right(self._market_cap_floors, event.market_cap)
+        yield from self._market_cap_rules[:end]
+        yield from self._unindexed
+
+    def match(self, event: PoolEvent) -> Dict[int, SnipeRule]:
+        # At most one buy per user per event: the largest matching rule wins
+        selected: Dict[int, SnipeRule] = {}
+        for rule in self._candidates(event):
+            if rule.matches(event):
+                current = selected.get(rule.user_id)
+                if current is None or rule.amount > current.amount:
+                    selected[rule.user_id] = rule
+        return selected
+
+snipe_rules = SnipeRuleEngine()
+
+async def snipe_token(user_id: int, token_address: str, amount: float, quote: Optional[Quote] = None) -> None:
+    success = await execute_trade(user_id, token_address, amount, "buy", PRIORITY_SNIPE, quote)
+    if success:
+        try:
+            await application.bot.send_message(chat_id=user_id, text=f"🎯 Sniped {amount} of {token_address}")
+        except Exception as e:
+            logger.error(f"Error sending snipe confirmation to user {user_id}: {e}")
+    else:
+        logger.warning(f"Snipe failed for user {user_id}: {token_address}")
+
+# =============================================================================
+# 19. WEBSOCKET MONITORING
+# =============================================================================
+async def handle_pump_message(message: Union[str, bytes], live: bool = True) -> None:
+    # live=False only parses and matches: no pool subscriptions, RPC calls or trades
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError as e:
+        logger.error(f"Error decoding websocket message: {e}")
+        return
+    if data.get("type") == "new_pool":
+        event = parse_pool_event(data)
+        if event is None:
+            return
+        async with orders_lock:
+            snipe_pools.append(data)
+            matches = snipe_rules.match(event)
+            # Only users with a live session are batch-quoted here; the rest
+            # load their settings and quote inside their own snipe task
+            slippages: Dict[int, float] = {}
+            for uid in matches if live else ():
+                session = sessions.peek(uid)
+                if session is not None:
+                    slippages[uid] = session.settings.get("slippage", DEFAULT_SLIPPAGE)
+        if not matches:
+            return
+        if not live:
+            logger.debug(f"Replay: {len(matches)} snipe rules matched {event.token}")
+            return
+        # Only mints someone is sniping get a cached, subscribed pool
+        try:
+            pool_cache.track_pump(
+                event.token, data.get("bondingCurveKey"),
+                data.get("vTokensInBondingCurve"), data.get("vSolInBondingCurve")
+            )
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error tracking bonding curve for {event.token}: {e}")
+        # One batch quote for every user buying this mint
+        quotes: Dict[int, Quote] = {}
+        if slippages:
+            batch = pool_cache.quote_batch(
+                event.token, "buy", [int(matches[uid].amount * 1e9) for uid in slippages], list(slippages.values())
+            )
+            quotes = dict(zip(slippages, batch or []))
+        for uid, rule in matches.items():
+            asyncio.create_task(snipe_token(uid, event.token, rule.amount, quotes.get(uid)))
+
 async def monitor_pump_launches() -> None:
     reconnect_delay = 5
-    while True:
+    recorder = PumpStreamRecorder(PUMP_RECORD_DIR) if PUMP_RECORD_DIR else None
+    flusher = asyncio.create_task(recorder.flush_periodically()) if recorder else None
+    try:
+        while True:
+            try:
+                async with websockets.connect(PUMP_WSS, ping_interval=20, ping_timeout=10) as ws:
+                    logger.info("Connected to Pump WebSocket")
+                    await ws.send(json.dumps({"type": "subscribe", "channel": "new_pools"}))
+                    async for message in ws:
+                        if recorder:
+                            recorder.append(message)
+                        await handle_pump_message(message)
+            except (websockets.exceptions.ConnectionClosed, aiohttp.ClientError) as e:
+                logger.error(f"WebSocket error: {e}")
+                await asyncio.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 1.5, 60)
+    finally:
+        if recorder:
+            flusher.cancel()
+            recorder.close()
+
+# =============================================================================
+# 20. STREAM RECORDING & REPLAY
+# =============================================================================
+# Segment files start with RECORD_MAGIC followed by records of
+# RECORD_HEADER (receive time in ns, frame length) + the raw frame bytes.
+RECORD_MAGIC = b"PUMPREC1"
+RECORD_HEADER = struct.Struct("<qI")
+
+class PumpStreamRecorder:
+    def __init__(self, directory: str, segment_bytes: int = PUMP_RECORD_SEGMENT_BYTES, flush_interval: float = 1.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_interval_ns = int(flush_interval * 1e9)
+        self._file = None
+        self._size = 0
+        self._last_flush = 0
+
+    def _open_segment(self, ts_ns: int) -> None:
+        if self._file:
+            self._file.close()
+        path = os.path.join(self.directory, f"pump-{ts_ns:020d}.seg")
+        self._file = open(path, "ab", buffering=1 << 20)
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._file.write(RECORD_MAGIC)
+            self._size = len(RECORD_MAGIC)
+        logger.info(f"Recording pump stream to {path}")
+
+    def append(self, frame: Union[str, bytes], ts_ns: Optional[int] = None) -> None:
+        if ts_ns is None:
+            ts_ns = time.time_ns()
+        payload = frame.encode() if isinstance(frame, str) else frame
         try:
-            async with websockets.connect(PUMP_WSS, ping_interval=20, ping_timeout=10) as ws:
-                logger.info("Connected to Pump WebSocket")
-                await ws.send(json.dumps({"type": "subscribe", "channel": "new_pools"}))
-                async for message in ws:
-                    try:
-                        data = json.loads(message)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Error decoding websocket message: {e}")
-                        continue
-                    if data.get("type") == "new_pool":
-                        token_address = data.get("token")
-                        async with orders_lock:
-                            snipe_pools.append(data)
-                            for uid, modes in active_snipers.items():
-                                if "pump" in modes:
-                                    success = await execute_trade(uid, token_address, 1.0, "buy")
-                                    if success:
-                                        try:
-                                            await application.bot.send_message(
-                                                chat_id=uid, text=f"🎯 Sniped 1.0 of {token_address}"
-                                            )
-                                        except Exception as e:
-                                            logger.error(f"Error sending snipe confirmation to user {uid}: {e}")
-                                    else:
-                                        logger.warning(f"Snipe failed for user {uid}: {token_address}")
-        except (websockets.exceptions.ConnectionClosed, aiohttp.ClientError) as e:
-            logger.error(f"WebSocket error: {e}")
-            await asyncio.sleep(reconnect_delay)
-            reconnect_delay = min(reconnect_delay * 1.5, 60)
+            if self._file is None or self._size >= self.segment_bytes:
+                self._open_segment(ts_ns)
+            self._file.write(RECORD_HEADER.pack(ts_ns, len(payload)))
+            self._file.write(payload)
+            self._size += RECORD_HEADER.size + len(payload)
+            if ts_ns - self._last_flush >= self.flush_interval_ns:
+                self._file.flush()
+                self._last_flush = ts_ns
+        except OSError as e:
+            logger.error(f"Error recording pump frame: {e}")
+
+    def flush(self) -> None:
+        if self._file:
+            try:
+                self._file.flush()
+            except OSError as e:
+                logger.error(f"Error flushing pump recording: {e}")
+            self._last_flush = time.time_ns()
+
+    async def flush_periodically(self) -> None:
+        # append() only flushes when a frame arrives; this covers a stream that goes quiet
+        while True:
+            await asyncio.sleep(self.flush_interval_ns / 1e9)
+            self.flush()
+
+    def close(self) -> None:
+        if self._file:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+def read_pump_stream(directory: str) -> Iterator[Tuple[int, bytes]]:
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("pump-") and name.endswith(".seg")):
+            continue
+        path = os.path.join(directory, name)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= len(RECORD_MAGIC):
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+                    logger.warning(f"Skipping {path}: not a pump stream segment")
+                    continue
+                offset = len(RECORD_MAGIC)
+                while offset + RECORD_HEADER.size <= size:
+                    ts_ns, length = RECORD_HEADER.unpack_from(mm, offset)
+                    start = offset + RECORD_HEADER.size
+                    end = start + length
+                    if end > size:
+                        # Partial record left by a crash mid-write
+                        logger.warning(f"Truncated record at offset {offset} in {path}")
+                        break
+                    yield ts_ns, mm[start:end]
+                    offset = end
+
+async def replay_pump_stream(
+    directory: str,
+    speed: float = 1.0,
+    handler: Optional[Callable[[bytes], Awaitable[None]]] = None,
+) -> int:
+    # speed=1.0 replays in real time, 10.0 ten times faster, 0 as fast as possible.
+    # The default handler is side-effect free; pass handle_pump_message to trade on the replay.
+    handler = handler or (lambda frame: handle_pump_message(frame, live=False))
+    count = 0
+    first_ts = None
+    started = time.monotonic()
+    for ts_ns, frame in read_pump_stream(directory):
+        if speed > 0:
+            if first_ts is None:
+                first_ts = ts_ns
+            delay = (ts_ns - first_ts) / 1e9 / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 1024 == 0:
+            await asyncio.sleep(0)
+        await handler(frame)
+        count += 1
+    elapsed = time.monotonic() - started
+    logger.info(f"Replayed {count} pump events from {directory} in {elapsed:.2f}s")
+    return count
+
+def load_snipe_rules_file(path: str, engine: SnipeRuleEngine) -> int:
+    # One rule per line in /snipe syntax ("0.5 name=pepe minliq=20"); each
+    # line becomes its own user (its line number) so counts stay per rule
+    loaded = 0
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            args = line.split("#", 1)[0].split()
+            if args:
+                engine.add(parse_snipe_rule(line_no, args))
+                loaded += 1
+    return loaded
+
+async def count_rule_matches(
+    directory: str, speed: float = 0.0, engine: Optional[SnipeRuleEngine] = None
+) -> Dict[SnipeRule, int]:
+    # Counts the rule each user would have bought with (one per user per event)
+    engine = engine or snipe_rules
+    counts: Dict[SnipeRule, int] = {}
+
+    async def count(frame: bytes) -> None:
+        try:
+            data = json.loads(frame)
+        except ValueError:
+            return
+        if data.get("type") != "new_pool":
+            return
+        event = parse_pool_event(data)
+        if event is None:
+            return
+        for rule in engine.match(event).values():
+            counts[rule] = counts.get(rule, 0) + 1
+
+    await replay_pump_stream(directory, speed, count)
+    return counts
+
+def run_replay_cli(directory: str, speed: float, rules_path: Optional[str]) -> None:
+    if rules_path:
+        loaded = load_snipe_rules_file(rules_path, snipe_rules)
+        logger.info(f"Loaded {loaded} snipe rules from {rules_path}")
+    else:
+        # Read-only: the journal may belong to a running bot
+        state_journal.restore(read_only=True)
+        logger.info(f"Loaded {len(snipe_rules.all_rules())} snipe rules from {STATE_DIR}")
+    counts = asyncio.run(count_rule_matches(directory, speed))
+    rules = sorted(snipe_rules.all_rules(), key=lambda rule: (-counts.get(rule, 0), rule.user_id))
+    for rule in rules:
+        print(f"{counts.get(rule, 0):>8}  user {rule.user_id}: {rule.describe()}")
 
 # =============================================================================
-# 13. UTILITY FUNCTIONS
+# 21. BACKTESTING
 # =============================================================================
+# Strategies are simulated with execute_trade semantics: an order spends
+# `amount` SOL, and it only fills if the price impact stays within the
+# slippage percentage (the min-out bound a real swap would enforce).
+# `liquidity` is the pool's SOL reserve at each sample; without it, fills
+# are assumed to have no price impact.
+BACKTEST_CHUNK_CELLS = 4_000_000
+
+@dataclass
+class BacktestResult:
+    params: Dict[str, np.ndarray]
+    spent: np.ndarray
+    tokens: np.ndarray
+    fills: np.ndarray
+    rejected: np.ndarray
+    final_value: np.ndarray
+    pnl: np.ndarray
+    pnl_pct: np.ndarray
+    avg_price: np.ndarray
+
+    def top(self, n: int = 10) -> List[Dict[str, float]]:
+        order = np.argsort(-self.pnl)[:n]
+        rows = []
+        for i in order:
+            row = {name: float(values[i]) for name, values in self.params.items()}
+            row.update(
+                spent=float(self.spent[i]), fills=int(self.fills[i]), rejected=int(self.rejected[i]),
+                pnl=float(self.pnl[i]), pnl_pct=float(self.pnl_pct[i]), avg_price=float(self.avg_price[i]),
+            )
+            rows.append(row)
+        return rows
+
+def load_price_series(path: str) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    # .npz with "timestamps" (seconds), "prices" (SOL per token) and optionally "liquidity" (SOL)
+    with np.load(path) as data:
+        liquidity = data["liquidity"].astype(np.float64) if "liquidity" in data.files else None
+        return data["timestamps"].astype(np.float64), data["prices"].astype(np.float64), liquidity
+
+def _simulate_fills(
+    prices: np.ndarray, liquidity: Optional[np.ndarray], amounts: np.ndarray, slippage: float, fee: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    spend = amounts * (1 - fee)
+    if liquidity is None:
+        impact = np.zeros(np.broadcast(spend, prices).shape)
+    else:
+        # Constant-product pool: receiving spend / price * liquidity / (liquidity + spend)
+        impact = spend / (liquidity + spend)
+    filled = impact * 100 <= slippage
+    tokens = np.where(filled, spend / prices * (1 - impact), 0.0)
+    return tokens, filled
+
+def _summarize(
+    params: Dict[str, np.ndarray], spent: np.ndarray, tokens: np.ndarray, fills: np.ndarray,
+    rejected: np.ndarray, last_price: float
+) -> BacktestResult:
+    final_value = tokens * last_price
+    pnl = final_value - spent
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pnl_pct = np.where(spent > 0, pnl / spent * 100, 0.0)
+        avg_price = np.where(tokens > 0, spent / tokens, 0.0)
+    return BacktestResult(params, spent, tokens, fills, rejected, final_value, pnl, pnl_pct, avg_price)
+
+def backtest_dca(
+    timestamps: np.ndarray,
+    prices: np.ndarray,
+    amounts: np.ndarray,
+    intervals: np.ndarray,
+    slippage: float = DEFAULT_SLIPPAGE,
+    liquidity: Optional[np.ndarray] = None,
+    fee: float = SWAP_FEE,
+) -> BacktestResult:
+    # One strategy per (amount, interval) pair, mirroring /createdca
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    prices = np.asarray(prices, dtype=np.float64)
+    liquidity = None if liquidity is None else np.asarray(liquidity, dtype=np.float64)
+    grid_amount, grid_interval = (g.ravel() for g in np.meshgrid(
+        np.asarray(amounts, dtype=np.float64), np.asarray(intervals, dtype=np.float64), indexing="ij"
+    ))
+    count = grid_amount.size
+    spent, tokens = np.zeros(count), np.zeros(count)
+    fills, rejected = np.zeros(count, dtype=np.int64), np.zeros(count, dtype=np.int64)
+    start, end = timestamps[0], timestamps[-1]
+
+    for interval in np.unique(grid_interval):
+        # schedule_dca sleeps before its first buy
+        buy_times = start + interval * np.arange(1, int((end - start) // interval) + 1)
+        if buy_times.size == 0:
+            continue
+        idx = np.searchsorted(timestamps, buy_times, side="right") - 1
+        buy_prices = prices[idx]
+        buy_liquidity = None if liquidity is None else liquidity[idx]
+        selected = np.flatnonzero(grid_interval == interval)
+        step = max(1, BACKTEST_CHUNK_CELLS // buy_times.size)
+        for lo in range(0, selected.size, step):
+            rows = selected[lo:lo + step]
+            order_amounts = grid_amount[rows][:, None]
+            got, filled = _simulate_fills(buy_prices, buy_liquidity, order_amounts, slippage, fee)
+            tokens[rows] = got.sum(axis=1)
+            spent[rows] = (order_amounts * filled).sum(axis=1)
+            fills[rows] = filled.sum(axis=1)
+            rejected[rows] = buy_times.size - fills[rows]
+
+    params = {"amount": grid_amount, "interval": grid_interval}
+    return _summarize(params, spent, tokens, fills, rejected, prices[-1])
+
+def backtest_limit_orders(
+    timestamps: np.ndarray,
+    prices: np.ndarray,
+    limit_prices: np.ndarray,
+    quantities: np.ndarray,
+    slippage: float = DEFAULT_SLIPPAGE,
+    liquidity: Optional[np.ndarray] = None,
+    fee: float = SWAP_FEE,
+) -> BacktestResult:
+    # One buy order per (limit price, quantity) pair; it triggers the first
+    # time the price trades at or below the limit
+    prices = np.asarray(prices, dtype=np.float64)
+    liquidity = None if liquidity is None else np.asarray(liquidity, dtype=np.float64)
+    grid_limit, grid_quantity = (g.ravel() for g in np.meshgrid(
+        np.asarray(limit_prices, dtype=np.float64), np.asarray(quantities, dtype=np.float64), indexing="ij"
+    ))
+    running_low = np.minimum.accumulate(prices)
+    trigger = np.searchsorted(-running_low, -grid_limit, side="left")
+    triggered = trigger < prices.size
+    idx = np.minimum(trigger, prices.size - 1)
+    fill_liquidity = None if liquidity is None else liquidity[idx]
+    got, filled = _simulate_fills(prices[idx], fill_liquidity, grid_quantity, slippage, fee)
+    filled &= triggered
+    tokens = np.where(filled, got, 0.0)
+    spent = np.where(filled, grid_quantity, 0.0)
+    fills = filled.astype(np.int64)
+    rejected = (triggered & ~filled).astype(np.int64)
+    params = {"limit_price": grid_limit, "quantity": grid_quantity}
+    return _summarize(params, spent, tokens, fills, rejected, prices[-1])
+
+# =============================================================================
+# 22. UTILITY FUNCTIONS
+# =============================================================================
+def set_pending_order(user_id: int, order: Dict[str, str]) -> None:
+    sessions.get(user_id).pending_order = order
+    state_journal.record("pending_orders", user_id, order)
+
+def drop_pending_order(user_id: int) -> bool:
+    session = sessions.peek(user_id)
+    if session is None or session.pending_order is None:
+        return False
+    session.pending_order = None
+    state_journal.record("pending_orders", user_id, None)
+    return True
+
 async def clear_pending_order(user_id: int, delay: int = 300) -> None:
     await asyncio.sleep(delay)
     async with orders_lock:
-        if user_id in pending_orders:
-            del pending_orders[user_id]
+        if drop_pending_order(user_id):
             logger.info(f"Cleared pending order for user {user_id} due to timeout")
 
 # =============================================================================
-# 14. MAIN APPLICATION SETUP
+# 23. STATE PERSISTENCE
+# =============================================================================
+# Runtime state survives restarts through a snapshot plus a write-ahead log.
+# Every mutation appends a (section, user, value) record to the current WAL
+# segment; value replaces that user's entry (None deletes it). Snapshots are
+# zlib-compressed JSON written atomically (temp file, fsync, rename), after
+# which WAL segments older than the snapshot are deleted. Only sections
+# touched since the last snapshot are re-encoded.
+SNAPSHOT_MAGIC = b"PFSNAP01"
+SNAPSHOT_HEADER = struct.Struct("<QII")  # last WAL seq, crc32, body length
+WAL_HEADER = struct.Struct("<QII")  # seq, crc32, payload length
+
+class StateJournal:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, "runtime.snap")
+        self.sections: Dict[str, Tuple[Callable[[], Dict[int, Any]], Callable[[int, Any], None]]] = {}
+        self._seq = 0
+        self._snapshot_seq = 0
+        self._dirty: set = set()
+        self._encoded: Dict[str, bytes] = {}
+        self._wal = None
+        self._unsynced = False
+        # write_snapshot runs on an executor thread while the final snapshot
+        # at shutdown runs on the loop; both share the .tmp path
+        self._write_lock = threading.Lock()
+        self._written_seq = -1
+
+    def register(self, name: str, dump_all: Callable[[], Dict[int, Any]], load_user: Callable[[int, Any], None]) -> None:
+        self.sections[name] = (dump_all, load_user)
+
+    def register_dict(self, name: str, mapping: Dict[int, Any]) -> None:
+        def load_user(user_id: int, value: Any) -> None:
+            if value is None:
+                mapping.pop(user_id, None)
+            else:
+                mapping[user_id] = value
+        self.register(name, lambda: mapping, load_user)
+
+    def _wal_segments(self) -> List[str]:
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith("runtime-") and n.endswith(".wal"))
+        return [os.path.join(self.directory, n) for n in names]
+
+    def _open_wal(self) -> None:
+        if self._wal:
+            self._wal.close()
+        self._wal = open(os.path.join(self.directory, f"runtime-{self._seq + 1:020d}.wal"), "ab")
+
+    def record(self, section: str, user_id: int, value: Any) -> None:
+        # Before restore() there is no WAL yet; nothing to journal
+        if self._wal is None:
+            return
+        self._seq += 1
+        payload = json.dumps({"s": section, "u": user_id, "v": value}, separators=(",", ":")).encode()
+        try:
+            self._wal.write(WAL_HEADER.pack(self._seq, zlib.crc32(payload), len(payload)) + payload)
+            self._wal.flush()
+            self._unsynced = True
+        except OSError as e:
+            logger.error(f"Error writing state WAL: {e}")
+        self._dirty.add(section)
+
+    def _apply(self, section: str, user_id: int, value: Any) -> None:
+        if section in self.sections:
+            self.sections[section][1](user_id, value)
+
+    def _read_wal(self, path: str, after_seq: int, read_only: bool = False) -> int:
+        applied = 0
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + WAL_HEADER.size <= len(data):
+            seq, crc, length = WAL_HEADER.unpack_from(data, offset)
+            start = offset + WAL_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            offset = start + length
+            self._seq = max(self._seq, seq)
+            if seq <= after_seq:
+                continue
+            entry = json.loads(payload)
+            self._apply(entry["s"], entry["u"], entry["v"])
+            applied += 1
+        if offset < len(data) and not read_only:
+            # Cut the torn tail off so records appended to this segment later stay readable
+            logger.warning(f"Discarding torn state WAL tail at offset {offset} in {path}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+        return applied
+
+    def restore(self, read_only: bool = False) -> int:
+        # read_only loads state without repairing or appending to the journal
+        if read_only and not os.path.isdir(self.directory):
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        restored = 0
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "rb") as f:
+                    data = f.read()
+                if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                    raise ValueError("bad magic")
+                seq, crc, length = SNAPSHOT_HEADER.unpack_from(data, len(SNAPSHOT_MAGIC))
+                body = data[len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size:]
+                if len(body) != length or zlib.crc32(body) != crc:
+                    raise ValueError("checksum mismatch")
+                for section, users in json.loads(zlib.decompress(body)).items():
+                    for user_id, value in users.items():
+                        self._apply(section, int(user_id), value)
+                        restored += 1
+                self._seq = self._snapshot_seq = seq
+            except (OSError, ValueError, struct.error, zlib.error) as e:
+                logger.error(f"Ignoring unreadable state snapshot {self.snapshot_path}: {e}")
+        for path in self._wal_segments():
+            restored += self._read_wal(path, self._snapshot_seq, read_only)
+        if read_only:
+            return restored
+        # Re-encode everything on the next snapshot. Torn tails were truncated
+        # above, so new records never land after one even if the newest
+        # segment is reopened
+        self._dirty = set(self.sections)
+        self._snapshot_seq = -1
+        self._open_wal()
+        return restored
+
+    def prepare_snapshot(self) -> Optional[Tuple[int, bytes]]:
+        if self._wal is None or self._seq == self._snapshot_seq:
+            return None
+        for name in self._dirty:
+            if name in self.sections:
+                users = self.sections[name][0]()
+                self._encoded[name] = json.dumps(
+                    {str(k): v for k, v in users.items()}, separators=(",", ":")
+                ).encode()
+        self._dirty.clear()
+        body = b"{" + b",".join(json.dumps(name).encode() + b":" + enc for name, enc in self._encoded.items()) + b"}"
+        self._snapshot_seq = self._seq
+        # Later records go to a new segment, so the older ones can be dropped
+        # once this snapshot is on disk
+        self._open_wal()
+        return self._seq, zlib.compress(body, 6)
+
+    def write_snapshot(self, seq: int, body: bytes) -> None:
+        with self._write_lock:
+            # An older snapshot finishing late must not replace a newer one
+            if seq <= self._written_seq:
+                return
+            self._write_snapshot(seq, body)
+            self._written_seq = seq
+
+    def _write_snapshot(self, seq: int, body: bytes) -> None:
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(seq, zlib.crc32(body), len(body)) + body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        for path in self._wal_segments():
+            first_seq = int(os.path.basename(path)[len("runtime-"):-len(".wal")])
+            if first_seq <= seq:
+                os.remove(path)
+
+    def sync(self) -> None:
+        if self._wal and self._unsynced:
+            os.fsync(self._wal.fileno())
+            self._unsynced = False
+
+    def snapshot(self) -> None:
+        prepared = self.prepare_snapshot()
+        if prepared:
+            self.write_snapshot(*prepared)
+
+state_journal = StateJournal(STATE_DIR)
+state_journal.register("snipe_rules", snipe_rules.dump_all, snipe_rules.load_user)
+state_journal.register_dict("dca_orders", dca_orders)
+state_journal.register_dict("limit_orders", limit_orders)
+
+def load_pending_order(user_id: int, order: Optional[Dict[str, str]]) -> None:
+    if order is not None or sessions.peek(user_id):
+        sessions.get(user_id).pending_order = order
+
+state_journal.register(
+    "pending_orders",
+    lambda: {session.user_id: session.pending_order for session in sessions.values() if session.pending_order},
+    load_pending_order,
+)
+state_journal.register_dict("copy_traders", copy_traders)
+
+def restore_runtime_state(loop: asyncio.AbstractEventLoop) -> None:
+    started = time.monotonic()
+    try:
+        restored = state_journal.restore()
+    except OSError as e:
+        logger.error(f"State restore failed: {e}")
+        return
+    for user_id, orders in dca_orders.items():
+        for order in orders:
+            loop.create_task(schedule_dca(user_id, order["token"], order["amount"], order["interval"]))
+    for user_id, addresses in copy_traders.items():
+        for address in addresses:
+            copy_tasks[(user_id, address)] = loop.create_task(monitor_trader(user_id, address))
+    for session in sessions.values():
+        if session.pending_order:
+            loop.create_task(clear_pending_order(session.user_id))
+    try:
+        resumed = tx_pipeline.restore()
+        if resumed:
+            logger.info(f"Resumed tracking {resumed} unconfirmed transactions")
+    except sqlite3.Error as e:
+        logger.error(f"Could not resume pending transactions: {e}")
+    logger.info(f"Restored {restored} state entries in {time.monotonic() - started:.3f}s")
+
+async def snapshot_runtime_state() -> None:
+    while True:
+        await asyncio.sleep(STATE_SNAPSHOT_INTERVAL)
+        try:
+            prepared = state_journal.prepare_snapshot()
+            if prepared:
+                await asyncio.get_running_loop().run_in_executor(None, state_journal.write_snapshot, *prepared)
+            else:
+                state_journal.sync()
+        except Exception as e:
+            logger.error(f"State snapshot failed: {e}")
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, price_history.flush)
+        except OSError as e:
+            logger.error(f"Price history flush failed: {e}")
+
+# =============================================================================
+# 24. MAIN APPLICATION SETUP
 # =============================================================================
 def main():
     global application
@@ -878,6 +3182,8 @@ def main():
         "wallet": wallet_prompt,
         "uploadkey": uploadkey,
         "sniper": sniper,
+        "snipe": snipe,
+        "stopsnipe": stopsnipe,
         "limitorders": limitorders,
         "dcaorders": dcaorders,
         "createdca": createdca,
@@ -900,12 +3206,28 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, pending_input_handler))
 
     loop = asyncio.get_event_loop()
+    restore_runtime_state(loop)
+    loop.create_task(snapshot_runtime_state())
     loop.create_task(monitor_pump_launches())
+    loop.create_task(pool_cache.run())
+    loop.create_task(reconcile_balances())
+    loop.create_task(tx_pipeline.run())
+    loop.create_task(sweep_sessions())
+    loop.create_task(wallet_pool.refill())
 
     def handle_shutdown():
+        try:
+            state_journal.snapshot()
+        except Exception as e:
+            logger.error(f"Final state snapshot failed: {e}")
+        try:
+            price_history.flush()
+        except OSError as e:
+            logger.error(f"Price history flush failed: {e}")
         tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
         for task in tasks:
             task.cancel()
+        crypto_executor.shutdown(wait=False, cancel_futures=True)
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
 
@@ -918,8 +3240,14 @@ def main():
     except KeyboardInterrupt:
         handle_shutdown()
     except Exception as e:
-        logger.error(f"Main loop error: {e}\n{traceback.format_exc()}")
+        logger.error(f"Main loop error: {e}", exc_info=True)
         handle_shutdown()
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) >= 3 and sys.argv[1] == "replay":
+        # python bot.py replay <DIR> [SPEED] [RULES_FILE]; without a rules file the saved snipe rules are used
+        run_replay_cli(
+            sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 0.0, sys.argv[4] if len(sys.argv) > 4 else None
+        )
+    else:
+        main()
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# bot.py creates bot.db, bot.log and the state directory in the working directory on import
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import bot
+
+TIMESTAMPS = np.array([0.0, 10.0, 20.0, 30.0, 40.0])
+PRICES = np.array([1.0, 2.0, 4.0, 2.0, 1.0])
+
+
+def row(result, **params):
+    (index,) = np.flatnonzero(np.logical_and.reduce([result.params[k] == v for k, v in params.items()]))
+    return index
+
+
+def test_backtest_dca_known_series():
+    result = bot.backtest_dca(TIMESTAMPS, PRICES, amounts=[1.0, 2.0], intervals=[10, 20], fee=0.0)
+    # Every 10s buys at 2, 4, 2, 1; every 20s buys at 4, 1
+    i = row(result, amount=1.0, interval=10)
+    assert result.fills[i] == 4 and result.rejected[i] == 0
+    assert result.spent[i] == pytest.approx(4.0)
+    assert result.tokens[i] == pytest.approx(2.25)
+    assert result.pnl[i] == pytest.approx(2.25 - 4.0)
+    assert result.avg_price[i] == pytest.approx(4.0 / 2.25)
+    j = row(result, amount=2.0, interval=20)
+    assert result.tokens[j] == pytest.approx(2.0 / 4 + 2.0 / 1)
+    assert result.spent[j] == pytest.approx(4.0)
+
+
+def test_backtest_dca_fee_and_slippage():
+    with_fee = bot.backtest_dca(TIMESTAMPS, PRICES, [1.0], [20], fee=0.01)
+    assert with_fee.tokens[0] == pytest.approx(0.99 * (1 / 4 + 1 / 1))
+    # 1 SOL into a 99 SOL pool moves the price ~1%, over a 0.5% slippage limit
+    thin = bot.backtest_dca(TIMESTAMPS, PRICES, [1.0, 0.1], [20], slippage=0.5, fee=0.0, liquidity=np.full(5, 99.0))
+    assert thin.fills.tolist() == [0, 2]
+    assert thin.rejected.tolist() == [2, 0]
+    kept = 1 - 0.1 / 99.1
+    assert thin.tokens[1] == pytest.approx((0.1 / 4 + 0.1 / 1) * kept)
+
+
+def test_backtest_limit_orders_trigger_on_first_touch():
+    prices = np.array([5.0, 4.0, 3.0, 6.0, 8.0])
+    result = bot.backtest_limit_orders(np.arange(5.0), prices, limit_prices=[4.5, 3.0, 2.0], quantities=[1.0], fee=0.0)
+    assert result.fills.tolist() == [1, 1, 0]
+    assert result.tokens.tolist() == pytest.approx([1 / 4, 1 / 3, 0.0])
+    assert result.pnl.tolist() == pytest.approx([8 / 4 - 1, 8 / 3 - 1, 0.0])
+    assert [r["limit_price"] for r in result.top(2)] == [3.0, 4.5]
+
+
+def test_load_price_series(tmp_path):
+    path = tmp_path / "series.npz"
+    np.savez(path, timestamps=TIMESTAMPS, prices=PRICES)
+    timestamps, prices, liquidity = bot.load_price_series(str(path))
+    assert timestamps.tolist() == TIMESTAMPS.tolist() and prices.tolist() == PRICES.tolist()
+    assert liquidity is None
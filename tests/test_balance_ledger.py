@@ -0,0 +1,103 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import bot
+
+SOL = 10 ** 9
+
+
+class FakeClient:
+    def __init__(self, balances):
+        self.balances = balances
+        self.calls = []
+
+    async def get_balance(self, pubkey, commitment=None):
+        self.calls.append(("get_balance", pubkey))
+        return SimpleNamespace(value=self.balances[pubkey])
+
+    async def get_multiple_accounts(self, pubkeys, commitment=None):
+        self.calls.append(("get_multiple_accounts", tuple(pubkeys)))
+        return SimpleNamespace(value=[SimpleNamespace(lamports=self.balances[p]) for p in pubkeys])
+
+
+def test_reserve_settle_release():
+    ledger = bot.BalanceLedger()
+    ledger.observe(1, "A", 10 * SOL)
+    first = ledger.reserve(1, 4 * SOL)
+    second = ledger.reserve(1, 4 * SOL)
+    assert ledger.reserve(1, 4 * SOL) is None
+    assert ledger.available(1) == 2 * SOL
+    ledger.release(first)
+    ledger.release(first)  # releasing twice is a no-op
+    assert ledger.available(1) == 6 * SOL
+    ledger.settle(second)
+    balance = ledger.wallets[1]
+    assert (balance.reserved, balance.spent, ledger.available(1)) == (0, 4 * SOL, 6 * SOL)
+    assert ledger.reserve(2, 1) is None
+
+
+def test_reads_inside_grace_keep_settled_spends():
+    ledger = bot.BalanceLedger()
+    ledger.observe(1, "A", 10 * SOL, observed_at=0)
+    ledger.settle(ledger.reserve(1, 3 * SOL))
+    # A read taken right after the trade may not include it yet
+    ledger.observe(1, "A", 10 * SOL)
+    assert ledger.available(1) == 7 * SOL
+    # One old enough to include it drops the local spend
+    ledger.observe(1, "A", 7 * SOL, observed_at=time.time() + bot.LEDGER_SETTLE_GRACE + 1)
+    assert (ledger.wallets[1].spent, ledger.available(1)) == (0, 7 * SOL)
+
+
+def test_reconcile_batches_active_wallets(monkeypatch):
+    client = FakeClient({"A": 5 * SOL, "B": 8 * SOL, "C": 1 * SOL})
+    monkeypatch.setattr(bot, "solana_client", client)
+    ledger = bot.BalanceLedger()
+    now = time.time()
+    ledger.observe(1, "A", 10 * SOL, observed_at=now)
+    ledger.observe(2, "B", 10 * SOL, observed_at=now)
+    ledger.observe(3, "C", 10 * SOL, observed_at=now - bot.LEDGER_IDLE_TTL - 1)
+    ledger.release(ledger.reserve(1, SOL))
+    ledger.release(ledger.reserve(2, SOL))
+    asyncio.run(ledger.reconcile())
+    assert client.calls == [("get_multiple_accounts", ("A", "B"))]
+    assert (ledger.available(1), ledger.available(2)) == (5 * SOL, 8 * SOL)
+    assert 3 not in ledger.wallets  # idle wallets are dropped, not re-read
+
+
+def trade(monkeypatch, chain, cached=None):
+    client = FakeClient({"Wallet": chain})
+    wallet = SimpleNamespace(public_key="Wallet")
+
+    async def get_wallet(user_id):
+        return wallet
+
+    pools = bot.PoolStateCache("ws://unused")
+    pools._add_pool("Mint", bot.PoolState(kind="raydium", address="Pool", token_reserve=10 ** 12, sol_reserve=SOL), {})
+    monkeypatch.setattr(bot, "solana_client", client)
+    monkeypatch.setattr(bot, "get_user_wallet", get_wallet)
+    monkeypatch.setattr(bot, "pool_cache", pools)
+    monkeypatch.setattr(bot, "balance_ledger", bot.BalanceLedger())
+    if cached is not None:
+        bot.balance_ledger.observe(5, "Wallet", cached)
+    return asyncio.run(bot.execute_trade(5, "Mint", 1.0)), client.calls
+
+
+def test_trade_rereads_stale_low_balance(monkeypatch):
+    ok, calls = trade(monkeypatch, chain=10 * SOL, cached=SOL // 100)
+    assert ok
+    assert calls == [("get_balance", "Wallet")]
+    assert bot.balance_ledger.available(5) == 9 * SOL
+
+
+def test_trade_rejected_when_chain_balance_is_low_too(monkeypatch):
+    ok, calls = trade(monkeypatch, chain=SOL // 2, cached=SOL // 100)
+    assert not ok
+    assert calls == [("get_balance", "Wallet")]
+    assert bot.balance_ledger.available(5) == SOL // 2
+
+
+def test_first_read_is_not_repeated(monkeypatch):
+    ok, calls = trade(monkeypatch, chain=SOL // 2)
+    assert not ok
+    assert calls == [("get_balance", "Wallet")]
@@ -0,0 +1,76 @@
+import io
+import logging
+import time
+
+import bot
+
+
+def make_record(msg, level=logging.ERROR, lineno=10, created=None):
+    record = logging.LogRecord("bot", level, "bot.py", lineno, msg, None, None)
+    if created is not None:
+        record.created = created
+    return record
+
+
+def test_sampler_keys_on_message():
+    sampler = bot.RepeatSampler(window=60, burst=2)
+    noisy = [sampler.filter(make_record("user 1 failed", created=0)) for _ in range(5)]
+    other = sampler.filter(make_record("user 2 failed", created=0))
+    assert noisy == [True, True, False, False, False]
+    assert other
+
+
+def test_sampler_reports_count_when_message_repeats_after_window():
+    sampler = bot.RepeatSampler(window=60, burst=1)
+    for _ in range(4):
+        sampler.filter(make_record("boom", created=0))
+    record = make_record("boom", created=61)
+    assert sampler.filter(record)
+    assert record.getMessage() == "boom [3 similar messages suppressed]"
+    assert sampler.expire(now=200) == []
+
+
+def test_sampler_expire_reports_quiet_messages():
+    sampler = bot.RepeatSampler(window=60, burst=1)
+    for _ in range(3):
+        sampler.filter(make_record("boom", created=0))
+    sampler.filter(make_record("fresh", created=50))
+    (summary,) = sampler.expire(now=61)
+    assert summary.getMessage() == "[2 similar messages suppressed] boom"
+    assert summary.levelno == logging.ERROR and summary.lineno == 10
+    assert sampler.expire(now=61) == []
+    assert sampler.expire() == []
+
+
+def test_sampler_info_passes_through():
+    sampler = bot.RepeatSampler(window=60, burst=0)
+    assert sampler.filter(make_record("hello", level=logging.INFO))
+
+
+def test_writer_drops_routine_records_when_full(tmp_path):
+    writer = bot.AsyncLogWriter(
+        str(tmp_path / "test.log"), logging.Formatter("%(levelname)s %(message)s"), 1 << 20, 1, 16, max_queue=2
+    )
+    for i in range(5):
+        writer.put(make_record(f"info {i}", level=logging.INFO))
+    assert writer.queue.qsize() == 2 and writer.dropped == 3
+    writer.start()
+    writer.stop()
+    text = (tmp_path / "test.log").read_text()
+    assert "info 0" in text and "info 4" not in text
+    assert "dropped 3 records" in text
+
+
+def test_writer_flushes_suppressed_counts_on_stop(tmp_path):
+    sampler = bot.RepeatSampler(window=3600, burst=1)
+    stream = io.StringIO()
+    writer = bot.AsyncLogWriter(
+        str(tmp_path / "test.log"), logging.Formatter("%(message)s"), 1 << 20, 1, 16, stream=stream, sampler=sampler
+    )
+    writer.start()
+    for _ in range(4):
+        record = make_record("boom", created=time.time())
+        if sampler.filter(record):
+            writer.put(record)
+    writer.stop()
+    assert (tmp_path / "test.log").read_text().splitlines() == ["boom", "[3 similar messages suppressed] boom"]
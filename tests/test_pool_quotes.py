@@ -0,0 +1,105 @@
+import asyncio
+import math
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+SOL = 10 ** 9
+
+
+def cache_with(mint, pool, accounts=None):
+    cache = bot.PoolStateCache("ws://unused")
+    cache._add_pool(mint, pool, accounts or {})
+    return cache
+
+
+def raydium(sol=100 * SOL, tokens=1_000_000 * 10 ** 6):
+    return bot.PoolState(kind="raydium", address="Pool", token_reserve=tokens, sol_reserve=sol)
+
+
+def test_constant_product_buy():
+    pool = raydium()
+    cache = cache_with("Mint", pool)
+    quote = cache.quote("Mint", "buy", SOL, 1.0)
+    net_in = SOL * (1 - bot.SWAP_FEE)
+    out = pool.token_reserve * net_in / (pool.sol_reserve + net_in)
+    assert quote.amount_in == SOL
+    assert quote.expected_out == math.floor(out)
+    assert quote.min_out == math.floor(out * 0.99)
+    assert quote.price_impact == pytest.approx(net_in / (pool.sol_reserve + net_in) * 100)
+
+
+def test_constant_product_sell_is_sized_in_lamports():
+    pool = raydium()
+    cache = cache_with("Mint", pool)
+    quote = cache.quote("Mint", "sell", SOL, 0.5)
+    tokens_in = math.floor(SOL * pool.token_reserve / pool.sol_reserve)
+    net_in = tokens_in * (1 - bot.SWAP_FEE)
+    out = pool.sol_reserve * net_in / (pool.token_reserve + net_in)
+    assert quote.amount_in == tokens_in
+    assert quote.expected_out == math.floor(out)
+    assert quote.expected_out < SOL
+
+
+def test_bonding_curve_fees_and_cap():
+    pool = bot.PoolState(
+        kind="pump", address="Curve", token_reserve=1_073_000_000 * 10 ** 6, sol_reserve=30 * SOL,
+        fee=bot.PUMP_FEE, real_token_reserve=10 * 10 ** 6,
+    )
+    cache = cache_with("Mint", pool)
+    # The real reserve caps what a buy can receive
+    assert cache.quote("Mint", "buy", SOL, 1.0).expected_out == 10 * 10 ** 6
+    sell = cache.quote("Mint", "sell", SOL, 1.0)
+    tokens_in = math.floor(SOL * pool.token_reserve / pool.sol_reserve)
+    # pump.fun takes its fee from the SOL paid out
+    out = pool.sol_reserve * tokens_in / (pool.token_reserve + tokens_in) * (1 - bot.PUMP_FEE)
+    assert sell.expected_out == math.floor(out)
+
+
+def test_batch_matches_single_quotes():
+    cache = cache_with("Mint", raydium())
+    sizes, slippages = [SOL // 10, SOL, 5 * SOL], [0.5, 1.0, 5.0]
+    batch = cache.quote_batch("Mint", "buy", sizes, slippages)
+    assert batch == [cache.quote("Mint", "buy", s, p) for s, p in zip(sizes, slippages)]
+
+
+def test_no_quote_for_completed_curve_or_unknown_mint():
+    pool = bot.PoolState(kind="pump", address="Curve", token_reserve=10, sol_reserve=10, complete=True)
+    cache = cache_with("Mint", pool)
+    assert cache.quote("Mint", "buy", SOL, 1.0) is None
+    assert cache.quote("Other", "buy", SOL, 1.0) is None
+
+
+def test_apply_decodes_curve_and_vault_accounts():
+    curve = bot.PoolState(kind="pump", address="Curve", fee=bot.PUMP_FEE)
+    cache = cache_with("Mint", curve, {"Curve": "curve"})
+    data = b"\0" * 8 + struct.pack("<QQQ", 500, 40, 300) + b"\0" * 16 + b"\1"
+    cache._apply("Curve", data, slot=7)
+    assert (curve.token_reserve, curve.sol_reserve, curve.real_token_reserve, curve.complete) == (500, 40, 300, True)
+    cache._apply("Curve", b"\0" * 8 + struct.pack("<QQQ", 1, 1, 1), slot=6)
+    assert curve.token_reserve == 500  # older slot ignored
+
+    pool = raydium(sol=0, tokens=0)
+    cache = cache_with("Ray", pool, {"TokenVault": "token_vault", "SolVault": "sol_vault"})
+    cache._apply("TokenVault", b"\0" * 64 + struct.pack("<Q", 1234), slot=1)
+    cache._apply("SolVault", b"\0" * 64 + struct.pack("<Q", 99), slot=1)
+    assert (pool.token_reserve, pool.sol_reserve) == (1234, 99)
+
+
+def test_execute_trade_uses_cached_raydium_pool(monkeypatch):
+    wallet = SimpleNamespace(public_key="Wallet")
+    bot.pool_cache._add_pool("CachedMint", raydium(), {})
+
+    async def no_lookup(*args, **kwargs):
+        raise AssertionError("fetch_pool_id called for a cached pool")
+
+    async def get_wallet(user_id):
+        return wallet
+
+    monkeypatch.setattr(bot, "fetch_pool_id", no_lookup)
+    monkeypatch.setattr(bot, "get_user_wallet", get_wallet)
+    bot.balance_ledger.observe(4242, "Wallet", 10 * SOL)
+    assert asyncio.run(bot.execute_trade(4242, "CachedMint", 0.1))
@@ -0,0 +1,75 @@
+import bot
+
+BARS = {1: 4, 60: 3}
+
+
+def history(directory=None, max_tokens=3):
+    return bot.PriceHistory(str(directory) if directory else None, max_tokens, BARS, pinned=("SOL",))
+
+
+def test_ticks_roll_into_every_width():
+    prices = history()
+    for ts, price in [(600.0, 1.0), (601.5, 3.0), (602.0, 0.5), (659.0, 2.0)]:
+        prices.record("A", price, ts)
+    (bar,) = prices.bars("A", 60)
+    assert (bar["start"], bar["open"], bar["high"], bar["low"], bar["close"], bar["ticks"]) == (600, 1, 3, 0.5, 2, 4)
+    # The 1s ring only keeps its last 4 buckets, so older ticks fall out of range
+    assert prices.bars("A", 1)["start"].tolist() == [659]
+    assert prices.latest("A") == (659.0, 2.0)
+    assert prices.latest("A", 60) == (600.0, 2.0)
+
+
+def test_ring_wraps_and_range_reads():
+    prices = history()
+    for i in range(5):
+        prices.record("A", float(i + 1), 600 + 60 * i)
+    assert prices.bars("A", 60)["start"].tolist() == [720, 780, 840]
+    assert prices.bars("A", 60, start=750, end=800)["start"].tolist() == [780]
+    times, closes, _ = prices.series("A", 60)
+    assert closes.tolist() == [3.0, 4.0, 5.0]
+    # Late ticks for a reused bucket are dropped
+    prices.record("A", 99.0, 600)
+    assert prices.bars("A", 60)["close"].tolist() == [3.0, 4.0, 5.0]
+
+
+def test_least_recently_updated_key_is_evicted():
+    prices = history()
+    for token in ["SOL", "A", "B"]:
+        prices.record(token, 1.0, 600)
+    # Reads are peeks: A stays the oldest update
+    assert prices.latest("A") is not None
+    assert len(prices.bars("A", 60)) == 1
+    prices.record("C", 1.0, 601)
+    assert prices.tokens() == ["SOL", "B", "C"]
+    assert prices.latest("A") is None
+    prices.record("D", 1.0, 602)
+    assert prices.tokens() == ["SOL", "C", "D"]
+    # The new key starts from an empty slot
+    assert prices.bars("D", 60)["ticks"].tolist() == [1]
+
+
+def test_history_survives_restart(tmp_path):
+    prices = history(tmp_path)
+    prices.record("B", 2.0, 700)
+    prices.record("A", 1.0, 600)
+    prices.record("A", 1.5, 660)
+    prices.flush()
+    del prices
+    reopened = history(tmp_path)
+    # Reloaded keys are ordered by their newest bar
+    assert reopened.tokens() == ["A", "B"]
+    assert reopened.bars("A", 60)["close"].tolist() == [1.0, 1.5]
+    assert reopened.latest("B") == (700.0, 2.0)
+    reopened.record("C", 3.0, 800)
+    reopened.record("D", 3.0, 800)
+    assert reopened.tokens() == ["B", "C", "D"]
+
+
+def test_layout_change_starts_fresh(tmp_path):
+    prices = history(tmp_path)
+    prices.record("A", 1.0, 600)
+    prices.flush()
+    del prices
+    resized = bot.PriceHistory(str(tmp_path), 3, {1: 5, 60: 3}, pinned=("SOL",))
+    assert resized.latest("A") is None
+    assert resized.tokens() == []
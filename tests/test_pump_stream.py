@@ -0,0 +1,95 @@
+import asyncio
+import json
+import os
+
+import bot
+
+
+def frame(mint, name="Pepe", liquidity=30):
+    return json.dumps({
+        "type": "new_pool", "mint": mint, "name": name, "symbol": name.upper(), "vSolInBondingCurve": liquidity,
+    })
+
+
+def record(directory, frames, **kwargs):
+    recorder = bot.PumpStreamRecorder(str(directory), **kwargs)
+    for i, data in enumerate(frames):
+        recorder.append(data, ts_ns=1_000_000_000 + i)
+    return recorder
+
+
+def test_record_and_read_round_trip(tmp_path):
+    frames = [frame(f"M{i}") for i in range(100)]
+    record(tmp_path, frames, segment_bytes=1024).close()
+    assert len(os.listdir(tmp_path)) > 1
+    read = list(bot.read_pump_stream(str(tmp_path)))
+    assert [data.decode() for _, data in read] == frames
+    assert [ts for ts, _ in read] == [1_000_000_000 + i for i in range(100)]
+
+
+def test_truncated_tail_is_skipped(tmp_path):
+    record(tmp_path, [frame("A"), frame("B")]).close()
+    (path,) = [os.path.join(tmp_path, name) for name in os.listdir(tmp_path)]
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert [data.decode() for _, data in bot.read_pump_stream(str(tmp_path))] == [frame("A")]
+
+
+def test_quiet_stream_is_flushed_on_timer(tmp_path):
+    recorder = bot.PumpStreamRecorder(str(tmp_path), flush_interval=0.01)
+    recorder.append(frame("A"), ts_ns=1)
+    assert list(bot.read_pump_stream(str(tmp_path))) == []
+
+    async def run():
+        flusher = asyncio.create_task(recorder.flush_periodically())
+        await asyncio.sleep(0.05)
+        flusher.cancel()
+
+    asyncio.run(run())
+    assert [data.decode() for _, data in bot.read_pump_stream(str(tmp_path))] == [frame("A")]
+    recorder.close()
+
+
+def test_default_replay_has_no_side_effects(tmp_path):
+    record(tmp_path, [frame(f"M{i}") for i in range(50)]).close()
+    queued = bot.pool_cache._outbox.qsize()
+    assert asyncio.run(bot.replay_pump_stream(str(tmp_path), 0)) == 50
+    assert bot.pool_cache._outbox.qsize() == queued
+    assert not any(f"M{i}" in bot.pool_cache.pools for i in range(50))
+
+
+def test_count_rule_matches_from_rules_file(tmp_path):
+    record(tmp_path / "rec", [frame("A", "Pepe", 30), frame("B", "Doge", 5), frame("C", "Pepe", 5)]).close()
+    rules_path = tmp_path / "rules.txt"
+    rules_path.write_text("# comment\n0.1 name=pepe\n0.2 minliq=20\n\n0.3 maxliq=10\n")
+    engine = bot.SnipeRuleEngine()
+    assert bot.load_snipe_rules_file(str(rules_path), engine) == 3
+    counts = asyncio.run(bot.count_rule_matches(str(tmp_path / "rec"), 0, engine))
+    by_line = {rule.user_id: counts.get(rule, 0) for rule in engine.all_rules()}
+    assert by_line == {2: 2, 3: 1, 5: 2}
+
+
+def test_live_stream_tracks_only_sniped_mints(monkeypatch):
+    sniped = []
+
+    async def snipe(user_id, token, amount, quote):
+        sniped.append((user_id, token, quote))
+
+    monkeypatch.setattr(bot, "snipe_token", snipe)
+    monkeypatch.setattr(bot, "snipe_rules", bot.SnipeRuleEngine())
+    bot.snipe_rules.add(bot.parse_snipe_rule(77, ["0.1", "name=wanted"]))
+
+    def curve(mint, name):
+        data = json.loads(frame(mint, name))
+        data.update(bondingCurveKey=f"{mint}Curve", vTokensInBondingCurve=1_000_000_000)
+        return json.dumps(data)
+
+    async def run():
+        await bot.handle_pump_message(curve("LiveSkip", "Other"))
+        await bot.handle_pump_message(curve("LiveHit", "Wanted"))
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert "LiveSkip" not in bot.pool_cache.pools
+    assert "LiveHit" in bot.pool_cache.pools
+    assert [(uid, token) for uid, token, _ in sniped] == [(77, "LiveHit")]
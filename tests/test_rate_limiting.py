@@ -0,0 +1,61 @@
+import asyncio
+
+import httpx
+import pytest
+from solana.exceptions import SolanaRpcException, handle_async_exceptions
+
+import bot
+
+
+def http_error(status, headers=None):
+    request = httpx.Request("POST", bot.RPC_URL)
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return httpx.HTTPStatusError(f"HTTP {status}", request=request, response=response)
+
+
+async def rpc_call(error):
+    # Same wrapping solana-py's HTTP provider applies to transport errors
+    @handle_async_exceptions(SolanaRpcException, httpx.HTTPStatusError)
+    async def post(provider, body):
+        raise error
+
+    await post(None, {"method": "getBalance"})
+
+
+def wrapped(error):
+    try:
+        asyncio.run(rpc_call(error))
+    except SolanaRpcException as exc:
+        return exc
+    raise AssertionError("rpc_call did not raise")
+
+
+def test_rate_limit_info_direct_http_error():
+    assert bot.rate_limit_info(http_error(429, {"Retry-After": "3"})) == (True, 3.0)
+
+
+def test_rate_limit_info_wrapped_rpc_error():
+    exc = wrapped(http_error(429, {"Retry-After": "3"}))
+    assert exc.__cause__ is not None
+    assert bot.rate_limit_info(exc) == (True, 3.0)
+    assert bot.rate_limit_info(wrapped(http_error(429))) == (True, None)
+
+
+def test_rate_limit_info_ignores_other_errors():
+    assert bot.rate_limit_info(wrapped(http_error(500))) == (False, None)
+    assert bot.rate_limit_info(ValueError("boom")) == (False, None)
+
+
+def test_wrapped_429_halves_rpc_concurrency():
+    limiter = bot.RateLimiter(bot.UPSTREAM_LIMITS)
+
+    async def run():
+        with pytest.raises(SolanaRpcException):
+            async with limiter.limit(bot.RPC_UPSTREAM):
+                await rpc_call(http_error(429, {"Retry-After": "0"}))
+
+    upstream = limiter.upstream(bot.RPC_UPSTREAM)
+    before = upstream.concurrency
+    asyncio.run(run())
+    assert upstream.concurrency == before / 2
+    assert upstream.in_flight == 0
@@ -0,0 +1,77 @@
+import pytest
+from solders.keypair import Keypair
+
+import bot
+
+CREATOR = str(Keypair().pubkey())
+
+
+def event(name="Pepe Coin", creator=None, liquidity=30.0, market_cap=40.0):
+    return bot.parse_pool_event({
+        "type": "new_pool", "mint": "Mint", "name": name, "symbol": name.split()[0].upper(),
+        "traderPublicKey": creator, "vSolInBondingCurve": liquidity, "marketCapSol": market_cap,
+    })
+
+
+def rule(user_id, *args):
+    return bot.parse_snipe_rule(user_id, list(args))
+
+
+def test_match_uses_each_index():
+    engine = bot.SnipeRuleEngine()
+    engine.add(rule(1, "0.1", f"creator={CREATOR}"))
+    engine.add(rule(2, "0.1", "name=pepe"))
+    engine.add(rule(3, "0.1", "minliq=25"))
+    engine.add(rule(4, "0.1", "minmc=50"))
+    engine.add(rule(5, "0.1", "maxliq=10"))
+    engine.add(rule(6, "0.1"))
+    assert set(engine.match(event(creator=CREATOR))) == {1, 2, 3, 6}
+    assert set(engine.match(event(name="Doge", liquidity=5, market_cap=60))) == {4, 5, 6}
+
+
+def test_one_buy_per_user_largest_amount_wins():
+    engine = bot.SnipeRuleEngine()
+    assert engine.add(rule(1, "0.1", "name=pepe"))
+    assert engine.add(rule(1, "0.5", "minliq=10"))
+    assert engine.add(rule(1, "0.3"))
+    assert not engine.add(rule(1, "0.3"))
+    matches = engine.match(event())
+    assert list(matches) == [1]
+    assert matches[1].amount == 0.5
+
+
+def test_remove_user_leaves_other_rules():
+    engine = bot.SnipeRuleEngine()
+    for user_id in (1, 2):
+        engine.add(rule(user_id, "0.1", "name=pepe"))
+        engine.add(rule(user_id, "0.2", "minliq=10"))
+        engine.add(rule(user_id, "0.3", "minliq=10", "maxmc=100"))
+        engine.add(rule(user_id, "0.4", "minmc=20"))
+        engine.add(rule(user_id, "0.5", "maxliq=100"))
+    assert engine.remove_user(1) == 5
+    assert engine.remove_user(1) == 0
+    assert engine.rules_for(1) == []
+    assert list(engine.match(event())) == [2]
+    assert engine.remove_user(2) == 5
+    assert engine.match(event()) == {}
+    assert engine._liquidity_floors == [] and engine._by_keyword == {}
+
+
+def test_dump_and_load_round_trip():
+    engine = bot.SnipeRuleEngine()
+    engine.add(rule(1, "0.1", "name=pepe", "maxmc=100"))
+    restored = bot.SnipeRuleEngine()
+    restored.load_user(1, engine.dump_user(1))
+    assert restored.rules_for(1) == engine.rules_for(1)
+    restored.load_user(1, None)
+    assert restored.rules_for(1) == []
+
+
+@pytest.mark.parametrize("name", ["pepe-coin", "$pepe", "two words"])
+def test_name_must_be_single_word(name):
+    with pytest.raises(ValueError):
+        rule(1, "0.1", f"name={name}")
+
+
+def test_name_keyword_is_case_insensitive():
+    assert rule(1, "0.1", "name=PEPE").name_keyword == "pepe"
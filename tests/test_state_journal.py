@@ -0,0 +1,109 @@
+import os
+
+import bot
+
+
+def make_journal(directory):
+    journal = bot.StateJournal(str(directory))
+    orders = {}
+    journal.register_dict("orders", orders)
+    return journal, orders
+
+
+def last_segment(directory):
+    return bot.StateJournal(str(directory))._wal_segments()[-1]
+
+
+def test_restore_round_trip(tmp_path):
+    journal, orders = make_journal(tmp_path)
+    journal.restore()
+    for user_id, value in [(1, "a"), (2, "b"), (3, "c")]:
+        orders[user_id] = value
+        journal.record("orders", user_id, value)
+    journal.snapshot()
+    orders[2] = "B"
+    journal.record("orders", 2, "B")
+    del orders[3]
+    journal.record("orders", 3, None)
+    journal.sync()
+
+    restored_journal, restored = make_journal(tmp_path)
+    restored_journal.restore()
+    assert restored == {1: "a", 2: "B"}
+
+
+def test_torn_tail_is_discarded(tmp_path):
+    journal, orders = make_journal(tmp_path)
+    journal.restore()
+    journal.record("orders", 1, "a")
+    journal.record("orders", 2, "b")
+    path = last_segment(tmp_path)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 2)
+
+    restored_journal, restored = make_journal(tmp_path)
+    restored_journal.restore()
+    assert restored == {1: "a"}
+
+
+def test_records_after_torn_segment_survive(tmp_path):
+    journal, orders = make_journal(tmp_path)
+    journal.restore()
+    journal.snapshot()
+    orders[1] = "a"
+    journal.record("orders", 1, "a")
+    journal.snapshot()
+    # The only record in the newest segment is torn
+    journal.record("orders", 2, "b")
+    path = last_segment(tmp_path)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 2)
+
+    second, restored = make_journal(tmp_path)
+    second.restore()
+    assert restored == {1: "a"}
+    second.record("orders", 4, "d")
+    second.sync()
+
+    third, restored = make_journal(tmp_path)
+    third.restore()
+    assert restored == {1: "a", 4: "d"}
+
+
+def test_late_older_snapshot_does_not_replace_newer(tmp_path):
+    journal, orders = make_journal(tmp_path)
+    journal.restore()
+    orders[1] = "a"
+    journal.record("orders", 1, "a")
+    older = journal.prepare_snapshot()
+    orders[2] = "b"
+    journal.record("orders", 2, "b")
+    journal.snapshot()
+    # The background write of the earlier snapshot lands after the final one
+    journal.write_snapshot(*older)
+    journal.sync()
+
+    restored_journal, restored = make_journal(tmp_path)
+    restored_journal.restore()
+    assert restored == {1: "a", 2: "b"}
+
+
+def test_concurrent_snapshot_writes_are_serialized(tmp_path):
+    import threading
+
+    journal, orders = make_journal(tmp_path)
+    journal.restore()
+    prepared = []
+    for user_id in range(20):
+        orders[user_id] = "x" * 1000
+        journal.record("orders", user_id, orders[user_id])
+        prepared.append(journal.prepare_snapshot())
+    threads = [threading.Thread(target=journal.write_snapshot, args=p) for p in reversed(prepared)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    restored_journal, restored = make_journal(tmp_path)
+    restored_journal.restore()
+    assert restored == orders
@@ -0,0 +1,171 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+from solders.hash import Hash
+from solders.keypair import Keypair
+from solders.system_program import TransferParams, transfer
+from solders.transaction_status import TransactionConfirmationStatus
+
+import bot
+
+KEYPAIR = Keypair()
+LAMPORTS = 10 ** 8
+
+
+def instructions(n):
+    return [transfer(TransferParams(from_pubkey=KEYPAIR.pubkey(), to_pubkey=Keypair().pubkey(), lamports=n))]
+
+
+def landed(err=None, status=TransactionConfirmationStatus.Confirmed):
+    return SimpleNamespace(err=err, confirmation_status=status, slot=5)
+
+
+class FakeRPC:
+    def __init__(self):
+        self.height = 100
+        self.statuses = {}
+        self.history = {}
+        self.lookups = []
+
+    async def get_latest_blockhash(self, commitment=None):
+        return SimpleNamespace(value=SimpleNamespace(blockhash=Hash.new_unique(), last_valid_block_height=self.height + 150))
+
+    async def get_block_height(self, commitment=None):
+        return SimpleNamespace(value=self.height)
+
+    async def get_signature_statuses(self, signatures, search_transaction_history=False):
+        self.lookups.append(search_transaction_history)
+        found = []
+        for sig in map(str, signatures):
+            status = self.statuses.get(sig)
+            if status is None and search_transaction_history:
+                status = self.history.get(sig)
+            found.append(status)
+        return SimpleNamespace(value=found)
+
+
+class FakeSender:
+    def __init__(self, ok=True, on_send=None):
+        self.ok = ok
+        self.on_send = on_send
+        self.sent = []
+
+    async def send_raw_transaction(self, raw, opts=None):
+        if self.on_send:
+            self.on_send(raw)
+        if not self.ok:
+            raise OSError("endpoint down")
+        self.sent.append(raw)
+
+
+@pytest.fixture
+def rpc(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    bot.init_db()
+    client = FakeRPC()
+    monkeypatch.setattr(bot, "solana_client", client)
+    monkeypatch.setattr(bot, "send_clients", [("rpc:a", FakeSender()), ("rpc:b", FakeSender(ok=False))])
+    monkeypatch.setattr(bot, "balance_ledger", bot.BalanceLedger())
+    monkeypatch.setattr(bot, "TX_REBROADCAST_INTERVAL", 0)
+    bot.balance_ledger.observe(1, "Wallet", 10 * LAMPORTS)
+    return client
+
+
+def journal(signature):
+    conn = sqlite3.connect("bot.db")
+    row = conn.execute("SELECT status, lamports FROM trade_signatures WHERE signature = ?", (signature,)).fetchone()
+    conn.close()
+    return row
+
+
+async def submit(pipeline, n):
+    return await pipeline.submit(1, KEYPAIR, instructions(n), f"BUY {n}", bot.balance_ledger.reserve(1, LAMPORTS))
+
+
+def test_statuses_settle_release_and_resend(rpc):
+    async def run():
+        pipeline = bot.TransactionPipeline(bot.BlockhashCache())
+        ok, failed, waiting = [await submit(pipeline, n) for n in (1, 2, 3)]
+        rpc.statuses[ok] = landed()
+        rpc.statuses[failed] = landed(err="InstructionError")
+        await pipeline._poll()
+        return pipeline, ok, failed, waiting
+
+    pipeline, ok, failed, waiting = asyncio.run(run())
+    assert list(pipeline.pending) == [waiting]
+    assert (journal(ok)[0], journal(failed)[0], journal(waiting)[0]) == ("confirmed", "failed", "sent")
+    balance = bot.balance_ledger.wallets[1]
+    assert (balance.reserved, balance.spent) == (LAMPORTS, LAMPORTS)
+    # The one still waiting was rebroadcast on the poll
+    assert len(bot.send_clients[0][1].sent) == 4
+
+
+def test_expiry_checks_history_first(rpc):
+    async def run():
+        pipeline = bot.TransactionPipeline(bot.BlockhashCache())
+        old, lost = await submit(pipeline, 1), await submit(pipeline, 2)
+        rpc.history[old] = landed(status=TransactionConfirmationStatus.Finalized)
+        rpc.height += 1000
+        await pipeline._poll()
+        return pipeline, old, lost
+
+    pipeline, old, lost = asyncio.run(run())
+    assert rpc.lookups == [False, True]
+    assert not pipeline.pending
+    assert (journal(old)[0], journal(lost)[0]) == ("confirmed", "expired")
+    assert bot.balance_ledger.wallets[1].reserved == 0
+
+
+def test_journal_written_before_broadcast(rpc, monkeypatch):
+    seen = []
+    pipeline = bot.TransactionPipeline(bot.BlockhashCache())
+
+    def check(raw):
+        conn = sqlite3.connect("bot.db")
+        seen.append(conn.execute("SELECT status, lamports FROM trade_signatures").fetchall())
+        conn.close()
+
+    monkeypatch.setattr(bot, "send_clients", [("rpc:a", FakeSender(on_send=check))])
+    signature = asyncio.run(submit(pipeline, 1))
+    assert seen == [[("sent", LAMPORTS)]]
+    assert journal(signature) == ("sent", LAMPORTS)
+
+    # Nothing accepted it: the journal row is removed again
+    monkeypatch.setattr(bot, "send_clients", [("rpc:a", FakeSender(ok=False))])
+    assert asyncio.run(submit(pipeline, 2)) is None
+    assert len(pipeline.pending) == 1
+    conn = sqlite3.connect("bot.db")
+    assert conn.execute("SELECT COUNT(*) FROM trade_signatures").fetchone() == (1,)
+    conn.close()
+
+
+def test_restored_transactions_hold_funds(rpc, monkeypatch):
+    async def run():
+        return await submit(bot.TransactionPipeline(bot.BlockhashCache()), 1)
+
+    signature = asyncio.run(run())
+    # Restart: the ledger is empty and the wallet has not been read yet
+    monkeypatch.setattr(bot, "balance_ledger", bot.BalanceLedger())
+    pipeline = bot.TransactionPipeline(bot.BlockhashCache())
+    assert pipeline.restore() == 1
+    assert bot.balance_ledger.wallets[1].reserved == LAMPORTS
+
+    async def first_read():
+        rpc.balance = 5 * LAMPORTS
+
+        async def get_balance(pubkey, commitment=None):
+            return SimpleNamespace(value=rpc.balance)
+
+        rpc.get_balance = get_balance
+        assert await bot.balance_ledger.ensure(1, "Wallet")
+        assert bot.balance_ledger.available(1) == 4 * LAMPORTS
+        rpc.statuses[signature] = landed()
+        await pipeline._poll()
+
+    asyncio.run(first_read())
+    balance = bot.balance_ledger.wallets[1]
+    assert balance.pubkey == "Wallet"
+    assert (balance.confirmed, balance.reserved, balance.spent) == (5 * LAMPORTS, 0, LAMPORTS)
+    assert journal(signature)[0] == "confirmed"
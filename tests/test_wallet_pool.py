@@ -0,0 +1,54 @@
+import asyncio
+import sqlite3
+
+import bot
+
+
+def clear_pool():
+    conn = sqlite3.connect("bot.db")
+    conn.execute("DELETE FROM wallet_pool")
+    conn.commit()
+    conn.close()
+
+
+def test_pooled_wallet_round_trip():
+    clear_pool()
+    bot.create_pooled_wallet()
+    assert bot.count_pooled_wallets() == 1
+    mnemonic, keypair = bot.take_pooled_wallet()
+    assert len(mnemonic.split()) in (12, 24)
+    assert bot.derive_keypair(mnemonic).pubkey() == keypair.pubkey()
+    assert bot.count_pooled_wallets() == 0
+    assert bot.take_pooled_wallet() is None
+
+
+def test_take_refills_pool():
+    clear_pool()
+    pool = bot.WalletPool(2)
+
+    async def run():
+        first = await pool.take()
+        await pool._refill_task
+        return first
+
+    assert asyncio.run(run()) is None
+    assert bot.count_pooled_wallets() == 2
+
+
+def test_wallet_lock_is_per_user():
+    order = []
+
+    async def hold(user_id, label, delay):
+        async with bot.user_wallet_lock(user_id):
+            order.append(f"{label} start")
+            await asyncio.sleep(delay)
+            order.append(f"{label} end")
+
+    async def run():
+        await asyncio.gather(hold(1, "a", 0.05), hold(1, "b", 0), hold(2, "c", 0))
+
+    asyncio.run(run())
+    # User 2 is not held up by user 1; user 1's second holder waits for the first
+    assert order.index("c end") < order.index("a end")
+    assert order.index("a end") < order.index("b start")
+    assert bot.wallet_locks == {}